@@ -33,6 +33,9 @@ if __name__ == "__main__":
     parser.add_argument("--n_cpu", type=int, default=0, help="number of cpu threads to use during batch generation")
     parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
     parser.add_argument("--checkpoint_model", type=str, help="path to checkpoint model")
+    parser.add_argument("--channels_last", action="store_true", help="run with channels-last weights and inputs")
+    parser.add_argument("--bf16", action="store_true", help="run the backbone under CPU bfloat16 autocast")
+    parser.add_argument("--check_parity", action="store_true", help="compare detections against a float32 model")
     opt = parser.parse_args()
     print(opt)
 
@@ -40,17 +43,13 @@ if __name__ == "__main__":
 
     os.makedirs("output", exist_ok=True)
 
-    # Set up model
-    model = Darknet(opt.model_def, img_size=opt.img_size).to(device)
-
-    if opt.weights_path.endswith(".weights"):
-        # Load darknet weights
-        model.load_darknet_weights(opt.weights_path)
-    else:
-        # Load checkpoint weights
-        model.load_state_dict(torch.load(opt.weights_path))
+    # Set up model (fused, in evaluation mode)
+    model = load_inference_model(
+        opt.model_def, opt.weights_path, opt.img_size, device, channels_last=opt.channels_last, bf16=opt.bf16
+    )
 
-    model.eval()  # Set in evaluation mode
+    # Default float32 model to check the selected inference mode against
+    reference = load_inference_model(opt.model_def, opt.weights_path, opt.img_size, device) if opt.check_parity else None
 
     dataloader = DataLoader(
         ImageFolder(opt.image_folder, img_size=opt.img_size),
@@ -74,8 +73,14 @@ if __name__ == "__main__":
 
         # Get detections
         with torch.no_grad():
-            detections = model(input_imgs)
-            detections = non_max_suppression(detections, opt.conf_thres, opt.nms_thres)
+            detections = model(input_imgs, compact=True, to_host=False, conf_thres=opt.conf_thres)
+            detections = non_max_suppression(detections, opt.conf_thres, opt.nms_thres, compact=True)
+            detections = [d if d is None else to_cpu(d) for d in detections]
+            if reference is not None:
+                expected = reference(input_imgs, compact=True, to_host=False, conf_thres=opt.conf_thres)
+                expected = non_max_suppression(expected, opt.conf_thres, opt.nms_thres, compact=True)
+                if not detections_agree(expected, detections):
+                    print("\t! Batch %d: detections differ from the float32 model" % batch_i)
 
         # Log progress
         current_time = time.time()
@@ -106,7 +111,9 @@ if __name__ == "__main__":
         # Draw bounding boxes and labels of detections
         if detections is not None:
             # Rescale boxes to original image
-            detections = rescale_boxes(detections, opt.img_size, img.shape[:2])
+            # ImageFolder letterboxes, so map back through the letterbox geometry
+            geometry = letterbox_geometry(img.shape[:2], opt.img_size)
+            detections = rescale_boxes(detections, opt.img_size, img.shape[:2], geometry)
             unique_labels = detections[:, -1].cpu().unique()
             n_cls_preds = len(unique_labels)
             bbox_colors = random.sample(colors, n_cls_preds)
@@ -0,0 +1,98 @@
+from __future__ import division
+
+from models import *
+from utils.utils import *
+
+import os
+import argparse
+
+import torch
+
+
+def export_torchscript(model, path, img_size, compact=False):
+    """
+    Traces the inference model at a fixed input size and freezes it for inference.
+    The saved module only takes the input batch and can be run with torch.jit.load alone.
+    torch.jit.optimize_for_inference is not applied: on CPU its modules cannot be loaded back.
+    """
+    example = torch.zeros((1, 3) + image_shape(img_size), device=next(model.parameters()).device)
+    with torch.no_grad():
+        scripted = torch.jit.trace(DarknetInference(model, compact=compact).eval(), example)
+        scripted = torch.jit.freeze(scripted)
+    torch.jit.save(scripted, path)
+
+
+def export_onnx(model, path, img_size, opset_version=11):
+    """
+    Exports the inference model, YOLO decode included, to ONNX with a dynamic batch dimension.
+    Outputs keep the (x, y, w, h, conf, cls...) layout expected by non_max_suppression.
+    """
+    example = torch.zeros((1, 3) + image_shape(img_size), device=next(model.parameters()).device)
+    with torch.no_grad():
+        torch.onnx.export(
+            DarknetInference(model).eval(),
+            example,
+            path,
+            opset_version=opset_version,
+            input_names=["images"],
+            output_names=["output"],
+            dynamic_axes={"images": {0: "batch"}, "output": {0: "batch"}},
+        )
+
+
+def check_parity(model, exported, img_size, compact=False, batch_size=2, rtol=1e-3, atol=1e-3):
+    """
+    Compares the decoded outputs of an exported model against the eager model on random inputs.
+    Boxes are in pixels, so the tolerance is mostly relative. 'exported' should be loaded back
+    from the saved file, so that the artifact itself is checked. Returns the max abs difference.
+    """
+    device = next(model.parameters()).device
+    imgs = torch.rand((batch_size, 3) + image_shape(img_size), device=device)
+    with torch.no_grad():
+        expected = model(imgs, compact=compact)
+        actual = to_cpu(exported(imgs))
+    torch.testing.assert_close(actual, expected, rtol=rtol, atol=atol, msg="Exported outputs differ from eager outputs")
+    return (expected - actual).abs().max().item()
+
+
+def publish(path, output):
+    """Moves a checked export to its final path"""
+    os.replace(path, output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_def", type=str, default="config/pchar-tiny.cfg", help="path to model definition file")
+    parser.add_argument("--weights_path", type=str, default="weights/pchar-tiny.weights", help="path to weights file")
+    parser.add_argument("--class_path", type=str, default="data/pchar84.names", help="path to class label file")
+    parser.add_argument("--img_size", type=parse_image_shape, default=416, help="input size, or HxW for rectangular inputs")
+    parser.add_argument("--format", type=str, default="pack", choices=["pack", "torchscript", "onnx"], help="export format")
+    parser.add_argument("--compact", action="store_true", help="export (x, y, w, h, conf, cls_conf, cls_pred) rows")
+    parser.add_argument("--output", type=str, help="path of the exported model (defaults next to the weights)")
+    opt = parser.parse_args()
+    print(opt)
+
+    output = opt.output or os.path.splitext(opt.weights_path)[0] + "." + opt.format
+
+    # Set up model
+    model = load_inference_model(opt.model_def, opt.weights_path, img_size=opt.img_size)
+
+    if opt.format == "pack":
+        model.save_packed(output, class_names=load_classes(opt.class_path), cfg_hash=config_hash(opt.model_def))
+    elif opt.format == "torchscript":
+        # Written next to the output and only moved there once the parity check passed
+        staging = output + ".partial"
+        export_torchscript(model, staging, opt.img_size, compact=opt.compact)
+        max_diff = check_parity(model, torch.jit.load(staging), opt.img_size, compact=opt.compact)
+        print(f"TorchScript parity check passed (max abs diff {max_diff:.2e})")
+        publish(staging, output)
+    elif opt.format == "onnx":
+        staging = output + ".partial"
+        export_onnx(model, staging, opt.img_size)
+        try:
+            max_diff = check_parity(model, OnnxModel(staging), opt.img_size)
+            print(f"onnxruntime parity check passed (max abs diff {max_diff:.2e})")
+        except ImportError:
+            print("onnxruntime is not installed, skipping the parity check")
+        publish(staging, output)
+    print(f"Saved {opt.format} model to {output}")
@@ -17,31 +17,22 @@ from torch.autograd import Variable
 
 import cv2
 
-# Transform image tensor (PIL), return final image tensor
-def transform_tensor(input_tensor, image_size, current_device):
-    padded_tensor, _ = pad_to_square(input_tensor, 0)
-    resize_tensor = resize(padded_tensor, image_size)
-    output_tensor = resize_tensor.unsqueeze(0)
 
-    output_tensor = Variable(output_tensor.type(torch.FloatTensor))
-    output_tensor = output_tensor.to(current_device)
-    return output_tensor
 
-
-def PlateDetection(plate_tensor, plateModel):
+def PlateDetection(plate_tensor, plate_geometry, plateModel):
     with torch.no_grad():
         start = time.time()
 
-        plate_detections = plateModel(plate_tensor)
-        plate_detections = non_max_suppression(plate_detections, opt.plate_thres, opt.plate_nms)
+        plate_detections = plateModel(plate_tensor, compact=True, to_host=False, conf_thres=opt.plate_thres)
+        plate_detections = non_max_suppression(plate_detections, opt.plate_thres, opt.plate_nms, compact=True)
 
         plate_time = float(time.time() - start) * 1000
 
         if plate_detections[0] is not None:
-            plate_detections = plate_detections[0]
+            # Only the surviving detections leave the device
+            plate_detections = to_cpu(plate_detections[0])
             # rescale box to origin image
-            plate_detections = torch.Tensor(plate_detections)
-            plate_detections = rescale_boxes(plate_detections, opt.plate_size, cvt_img.shape[:2])
+            plate_detections = rescale_boxes(plate_detections, opt.plate_size, cvt_img.shape[:2], plate_geometry)
         else:
             plate_detections = []
 
@@ -50,32 +41,25 @@ def PlateDetection(plate_tensor, plateModel):
 
 def CharRecognition(input_image, color_id, charModel):
     with torch.no_grad():
-        plate_pil = Image.fromarray(input_image)
-
-        # to Tensor
-        # char_tensor = transforms.ToTensor()(plate_pil)
-
-        ## not torchvision
-        img_tensor = np.array(plate_pil)
-        img_tensor = torch.from_numpy(img_tensor).float().to(device)
-        img_tensor = img_tensor.permute(2,0,1) / 255.
-
-        char_tensor = transform_tensor(img_tensor, opt.char_size, device)
+        # Letterbox the RGB crop into the model input
+        char_tensor, char_geometry = char_letterbox(input_image)
 
         c_start = time.time()
-        char_detections = charModel(char_tensor)
+        char_detections = charModel(char_tensor, compact=True, to_host=False, conf_thres=opt.char_thres)
         char_detections = non_max_suppression(char_detections,
                                                 opt.char_thres,
-                                                opt.char_nms)
+                                                opt.char_nms,
+                                                compact=True)
 
         char_time = float(time.time() - c_start) * 1000
 
         # Error prevention
         if char_detections[0] is not None:
-            char_detections = char_detections[0]
+            char_detections = to_cpu(char_detections[0])
             char_detections = rescale_boxes(char_detections,
                                                 opt.char_size,
-                                                input_image.shape[:2])
+                                                input_image.shape[:2],
+                                                char_geometry)
 
             # Postprocessing
             sorted_boxes = sort_boxes(char_detections)
@@ -96,7 +80,7 @@ if __name__ == "__main__":
     parser.add_argument("--plate_names", default="data/plate_color.names", type=str)
     parser.add_argument("--plate_thres", default=0.5, type=float)
     parser.add_argument("--plate_nms", default=0.5, type=float)
-    parser.add_argument("--plate_size", default=512, type=int)
+    parser.add_argument("--plate_size", default=512, type=parse_image_shape, help="input size, or HxW for rectangular inputs")
 
     # Character Detection
     parser.add_argument("--char_config", default="config/pchar-tiny.cfg", type=str)
@@ -104,11 +88,14 @@ if __name__ == "__main__":
     parser.add_argument("--char_names", default="data/pchar84.names", type=str)
     parser.add_argument("--char_thres", default=0.5, type=float)
     parser.add_argument("--char_nms", default=0.5, type=float)
-    parser.add_argument("--char_size", default=512, type=int)
+    parser.add_argument("--char_size", default=512, type=parse_image_shape, help="input size, or HxW for rectangular inputs")
 
     parser.add_argument("--batch_size", default=1, type=int)
     parser.add_argument("--n_cpu", default=0, type=int)
     parser.add_argument("--cuda", default="cuda", type=str, help="cpu or cuda")
+    parser.add_argument("--backend", default="torch", type=str, choices=["torch", "onnx"], help="inference backend")
+    parser.add_argument("--channels_last", action="store_true", help="torch backend: channels-last memory format")
+    parser.add_argument("--bf16", action="store_true", help="torch backend: CPU bfloat16 autocast")
     opt = parser.parse_args()
 
     if opt.cuda == "cuda":
@@ -118,6 +105,7 @@ if __name__ == "__main__":
 
     # Check Init.
     print("\t => Device ", device)
+    print("\t => Backend ", opt.backend)
 
     print("\t => Plate Information")
     print("\t\t => config : ", opt.plate_config)
@@ -135,21 +123,22 @@ if __name__ == "__main__":
     print("\t\t => threshold : ", opt.char_thres)
     print("\t\t => nms : ", opt.char_nms)
 
-    # Set up my model
-    plateModel = Darknet(opt.plate_config, img_size=opt.plate_size).to(device)
-    charModel = Darknet(opt.char_config, img_size=opt.char_size).to(device)
-
-    if opt.plate_weights.endswith(".weights"):
-        # Load darknet weights
-        plateModel.load_darknet_weights(opt.plate_weights)
-        charModel.load_darknet_weights(opt.char_weights)
+    # Set up my model (darknet weights, checkpoint or packed artifact), fused and in eval mode
+    if opt.backend == "onnx":
+        # Weights are models exported with export.py --format onnx
+        plateModel = OnnxModel(opt.plate_weights)
+        charModel = OnnxModel(opt.char_weights)
     else:
-        # Load checkpoint wieghts
-        print("to do...")
+        plateModel = load_inference_model(
+            opt.plate_config, opt.plate_weights, opt.plate_size, device, opt.channels_last, opt.bf16
+        )
+        charModel = load_inference_model(
+            opt.char_config, opt.char_weights, opt.char_size, device, opt.channels_last, opt.bf16
+        )
 
-    # LPR model to eval
-    plateModel.eval()
-    charModel.eval()
+    # Reused uint8 letterbox buffers and model inputs
+    plate_letterbox = Letterbox(opt.plate_size, device)
+    char_letterbox = Letterbox(opt.char_size, device)
 
     # load obj names (Char : EN name)
     p_names = load_classes(opt.plate_names)
@@ -180,19 +169,9 @@ if __name__ == "__main__":
             gray_img = cv2.cvtColor(cvt_img, cv2.COLOR_RGB2GRAY)
             cvt_img = cv2.cvtColor(gray_img, cv2.COLOR_GRAY2RGB)
 
-            pil_img = Image.fromarray(cvt_img)
-
-            # torchvision
-            # img_tensor = transforms.ToTensor()(pil_img)
-
-            ## not torchvision
-            img_tensor = np.array(pil_img)
-            img_tensor = torch.from_numpy(img_tensor).float().to(device)
-            img_tensor = img_tensor.permute(2, 0, 1) / 255.
-
-            plate_tensor = transform_tensor(img_tensor, opt.plate_size, device)
+            plate_tensor, plate_geometry = plate_letterbox(cvt_img)
 
-            plate_detections, plate_time = PlateDetection(plate_tensor, plateModel)
+            plate_detections, plate_time = PlateDetection(plate_tensor, plate_geometry, plateModel)
             plate_time_list.append(plate_time)
 
             # Result of plate detections
@@ -1,5 +1,12 @@
 from __future__ import division
 
+import os
+import math
+import json
+import hashlib
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -7,11 +14,16 @@ from torch.autograd import Variable
 import numpy as np
 
 from utils.parse_config import *
-from utils.utils import build_targets, to_cpu, non_max_suppression
+from utils.utils import build_targets, to_cpu, non_max_suppression, compact_predictions
+from utils.utils import select_candidates, split_candidates
 
 # import matplotlib.pyplot as plt
 # import matplotlib.patches as patches
 
+# Packed inference artifact: magic, header length, JSON header, then tensor data aligned to PACK_ALIGN
+PACK_MAGIC = b"LPRPACK1"
+PACK_ALIGN = 64
+
 
 def create_modules(module_defs):
     """
@@ -83,6 +95,59 @@ def create_modules(module_defs):
     return hyperparams, module_list
 
 
+def fold_batch_norm(conv, bn):
+    """
+    Folds the scale/shift and running statistics of 'bn' into 'conv' in place.
+    'conv' must own a bias, which is taken as the pre-normalization bias.
+    """
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        conv.weight.mul_(scale.view(-1, 1, 1, 1))
+        conv.bias.copy_((conv.bias - bn.running_mean) * scale + bn.bias)
+    return conv
+
+
+def fuse_conv_and_bn(conv, bn):
+    """ Returns a biased copy of 'conv' with 'bn' folded into its weights """
+    fused = nn.Conv2d(
+        in_channels=conv.in_channels,
+        out_channels=conv.out_channels,
+        kernel_size=conv.kernel_size,
+        stride=conv.stride,
+        padding=conv.padding,
+        bias=True,
+    ).to(conv.weight.device)
+    with torch.no_grad():
+        fused.weight.copy_(conv.weight)
+        if conv.bias is None:
+            fused.bias.zero_()
+        else:
+            fused.bias.copy_(conv.bias)
+    return fold_batch_norm(fused, bn)
+
+
+def config_hash(path):
+    """Returns the SHA-1 of a model definition file"""
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+@contextmanager
+def skip_init():
+    """Skips the random initialization of conv and batch norm layers built inside the block"""
+    patched = [(cls, cls.__dict__.get("reset_parameters")) for cls in (nn.Conv2d, nn.BatchNorm2d)]
+    for cls, _ in patched:
+        cls.reset_parameters = lambda self: None
+    try:
+        yield
+    finally:
+        for cls, reset_parameters in patched:
+            if reset_parameters is None:
+                del cls.reset_parameters
+            else:
+                cls.reset_parameters = reset_parameters
+
+
 class Upsample(nn.Module):
     """ nn.Upsample is deprecated """
 
@@ -118,36 +183,107 @@ class YOLOLayer(nn.Module):
         self.noobj_scale = 100
         self.metrics = {}
         self.img_dim = img_dim
-        self.grid_size = 0  # grid size
-
-    def compute_grid_offsets(self, grid_size, cuda=True):
-        self.grid_size = grid_size
-        g = self.grid_size
-        FloatTensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
-        self.stride = self.img_dim / self.grid_size
-        # Calculate offsets for each grid
-        self.grid_x = torch.arange(g).repeat(g, 1).view([1, 1, g, g]).type(FloatTensor)
-        self.grid_y = torch.arange(g).repeat(g, 1).t().view([1, 1, g, g]).type(FloatTensor)
-        self.scaled_anchors = FloatTensor([(a_w / self.stride, a_h / self.stride) for a_w, a_h in self.anchors])
-        self.anchor_w = self.scaled_anchors[:, 0:1].view((1, self.num_anchors, 1, 1))
-        self.anchor_h = self.scaled_anchors[:, 1:2].view((1, self.num_anchors, 1, 1))
-
-    def forward(self, x, targets=None, img_dim=None):
-
-        # Tensors for cuda support
-        FloatTensor = torch.cuda.FloatTensor if x.is_cuda else torch.FloatTensor
-        LongTensor = torch.cuda.LongTensor if x.is_cuda else torch.LongTensor
-        ByteTensor = torch.cuda.ByteTensor if x.is_cuda else torch.ByteTensor
+        self._grid_cache = {}
 
-        self.img_dim = img_dim
+    def grid_offsets(self, grid_size, img_dim, device, dtype):
+        """
+        Returns (grid_xy, anchor_wh, scaled_anchors, stride) for a (grid_h, grid_w) grid of an
+        input 'img_dim' pixels high, cached per (grid_size, img_dim, device, dtype). grid_xy holds
+        the cell offsets, anchor_wh the anchors in pixels and scaled_anchors the anchors in grid units.
+        """
+        key = (grid_size, img_dim, device, dtype)
+        if key not in self._grid_cache:
+            grid_h, grid_w = grid_size
+            # Inputs are multiples of the stride, so it is the same along both axes
+            stride = img_dim / grid_h
+            # Calculate offsets for each grid
+            grid_y, grid_x = torch.meshgrid(torch.arange(grid_h), torch.arange(grid_w))
+            grid_xy = torch.stack((grid_x, grid_y), -1).view(1, 1, grid_h, grid_w, 2).to(device=device, dtype=dtype)
+            anchors = torch.tensor(self.anchors, device=device, dtype=dtype)
+            anchor_wh = anchors.view(1, self.num_anchors, 1, 1, 2)
+            self._grid_cache[key] = (grid_xy, anchor_wh, anchors / stride, stride)
+        return self._grid_cache[key]
+
+    def decode(self, prediction, grid_xy, anchor_wh, stride, compact=False):
+        """
+        Decodes raw predictions (num_samples, num_anchors, grid_h, grid_w, num_classes + 5) in place into
+        (x, y, w, h, conf, cls...) in pixels. With 'compact' the class columns are reduced to
+        (cls_conf, cls_pred), applying the sigmoid to the best class only.
+        """
+        num_samples = prediction.size(0)
+        if torch.jit.is_tracing():
+            # Exporters do not handle in-place updates of slices well, so build the output functionally
+            xy = (torch.sigmoid(prediction[..., :2]) + grid_xy) * stride
+            wh = torch.exp(prediction[..., 2:4]) * anchor_wh
+            conf = torch.sigmoid(prediction[..., 4:5])
+            if compact:
+                cls_conf, cls_pred = prediction[..., 5:].max(-1, keepdim=True)
+                cls = (torch.sigmoid(cls_conf), cls_pred.to(prediction.dtype))
+            else:
+                cls = (torch.sigmoid(prediction[..., 5:]),)
+            output = torch.cat((xy, wh, conf) + cls, -1)
+            return output.view(num_samples, -1, output.size(-1))
+
+        prediction[..., :2].sigmoid_().add_(grid_xy).mul_(stride)
+        prediction[..., 2:4].exp_().mul_(anchor_wh)
+        if not compact:
+            prediction[..., 4:].sigmoid_()
+            return prediction.view(num_samples, -1, self.num_classes + 5)
+
+        output = prediction.new_empty(prediction.shape[:-1] + (7,))
+        output[..., :4] = prediction[..., :4]
+        output[..., 4] = prediction[..., 4].sigmoid_()
+        cls_conf, cls_pred = prediction[..., 5:].max(-1)
+        output[..., 5] = cls_conf.sigmoid_()
+        output[..., 6] = cls_pred
+        return output.view(num_samples, -1, 7)
+
+    def decode_candidates(self, prediction, anchor_wh, stride, conf_thres, compact=False):
+        """
+        Decodes only the predictions with object confidence >= 'conf_thres', straight into
+        (x1, y1, x2, y2, conf, cls...) rows (compact rows with 'compact').
+        Returns the rows and the image index of each row.
+        """
+        # Threshold the raw logits, so the sigmoid is only taken for candidates
+        if conf_thres <= 0:
+            conf_logit = -float("inf")
+        elif conf_thres >= 1:
+            conf_logit = float("inf")
+        else:
+            conf_logit = math.log(conf_thres / (1 - conf_thres))
+        image_i, anchor_i, grid_j, grid_i = (prediction[..., 4] >= conf_logit).nonzero(as_tuple=True)
+        rows = prediction[image_i, anchor_i, grid_j, grid_i]
+
+        xy = (torch.sigmoid(rows[:, :2]) + torch.stack((grid_i, grid_j), 1).to(rows.dtype)) * stride
+        wh = torch.exp(rows[:, 2:4]) * anchor_wh.view(-1, 2)[anchor_i]
+        conf = torch.sigmoid(rows[:, 4:5])
+        if compact:
+            cls_conf, cls_pred = rows[:, 5:].max(1, keepdim=True)
+            cls = (torch.sigmoid(cls_conf), cls_pred.to(rows.dtype))
+        else:
+            cls = (torch.sigmoid(rows[:, 5:]),)
+        return torch.cat((xy - wh / 2, xy + wh / 2, conf) + cls, 1), image_i
+
+    def forward(self, x, targets=None, img_dim=None, compact=False, conf_thres=None):
+        """'img_dim' is the input height, inputs may be rectangular"""
+        img_dim = img_dim or self.img_dim
         num_samples = x.size(0)
-        grid_size = x.size(2)
+        grid_h, grid_w = x.size(2), x.size(3)
+        grid_size = grid_h
 
         prediction = (
-            x.view(num_samples, self.num_anchors, self.num_classes + 5, grid_size, grid_size)
+            x.view(num_samples, self.num_anchors, self.num_classes + 5, grid_h, grid_w)
             .permute(0, 1, 3, 4, 2)
             .contiguous()
         )
+        grid_xy, anchor_wh, scaled_anchors, stride = self.grid_offsets(
+            (grid_h, grid_w), img_dim, x.device, x.dtype
+        )
+
+        if targets is None and conf_thres is not None:
+            return self.decode_candidates(prediction, anchor_wh, stride, conf_thres, compact), 0
+        if targets is None:
+            return self.decode(prediction, grid_xy, anchor_wh, stride, compact), 0
 
         # Get outputs
         x = torch.sigmoid(prediction[..., 0])  # Center x
@@ -157,189 +293,462 @@ class YOLOLayer(nn.Module):
         pred_conf = torch.sigmoid(prediction[..., 4])  # Conf
         pred_cls = torch.sigmoid(prediction[..., 5:])  # Cls pred.
 
-        # If grid size does not match current we compute new offsets
-        if grid_size != self.grid_size:
-            self.compute_grid_offsets(grid_size, cuda=x.is_cuda)
-
         # Add offset and scale with anchors
-        pred_boxes = FloatTensor(prediction[..., :4].shape)
-        pred_boxes[..., 0] = x.data + self.grid_x
-        pred_boxes[..., 1] = y.data + self.grid_y
-        pred_boxes[..., 2] = torch.exp(w.data) * self.anchor_w
-        pred_boxes[..., 3] = torch.exp(h.data) * self.anchor_h
+        pred_boxes = torch.cat(
+            (
+                torch.stack((x.data, y.data), -1) + grid_xy,
+                torch.exp(prediction[..., 2:4].data) * (anchor_wh / stride),
+            ),
+            -1,
+        )
 
         output = torch.cat(
             (
-                pred_boxes.view(num_samples, -1, 4) * self.stride,
+                pred_boxes.view(num_samples, -1, 4) * stride,
                 pred_conf.view(num_samples, -1, 1),
                 pred_cls.view(num_samples, -1, self.num_classes),
             ),
             -1,
         )
 
-        if targets is None:
-            return output, 0
-        else:
-            iou_scores, class_mask, obj_mask, noobj_mask, tx, ty, tw, th, tcls, tconf = build_targets(
-                pred_boxes=pred_boxes,
-                pred_cls=pred_cls,
-                target=targets,
-                anchors=self.scaled_anchors,
-                ignore_thres=self.ignore_thres,
-            )
-
-            # Loss : Mask outputs to ignore non-existing objects (except with conf. loss)
-            loss_x = self.mse_loss(x[obj_mask], tx[obj_mask])
-            loss_y = self.mse_loss(y[obj_mask], ty[obj_mask])
-            loss_w = self.mse_loss(w[obj_mask], tw[obj_mask])
-            loss_h = self.mse_loss(h[obj_mask], th[obj_mask])
-            loss_conf_obj = self.bce_loss(pred_conf[obj_mask], tconf[obj_mask])
-            loss_conf_noobj = self.bce_loss(pred_conf[noobj_mask], tconf[noobj_mask])
-            loss_conf = self.obj_scale * loss_conf_obj + self.noobj_scale * loss_conf_noobj
-            loss_cls = self.bce_loss(pred_cls[obj_mask], tcls[obj_mask])
-            total_loss = loss_x + loss_y + loss_w + loss_h + loss_conf + loss_cls
-
-            # Metrics
-            cls_acc = 100 * class_mask[obj_mask].mean()
-            conf_obj = pred_conf[obj_mask].mean()
-            conf_noobj = pred_conf[noobj_mask].mean()
-            conf50 = (pred_conf > 0.5).float()
-            iou50 = (iou_scores > 0.5).float()
-            iou75 = (iou_scores > 0.75).float()
-            detected_mask = conf50 * class_mask * tconf
-            precision = torch.sum(iou50 * detected_mask) / (conf50.sum() + 1e-16)
-            recall50 = torch.sum(iou50 * detected_mask) / (obj_mask.sum() + 1e-16)
-            recall75 = torch.sum(iou75 * detected_mask) / (obj_mask.sum() + 1e-16)
-
-            self.metrics = {
-                "loss": to_cpu(total_loss).item(),
-                "x": to_cpu(loss_x).item(),
-                "y": to_cpu(loss_y).item(),
-                "w": to_cpu(loss_w).item(),
-                "h": to_cpu(loss_h).item(),
-                "conf": to_cpu(loss_conf).item(),
-                "cls": to_cpu(loss_cls).item(),
-                "cls_acc": to_cpu(cls_acc).item(),
-                "recall50": to_cpu(recall50).item(),
-                "recall75": to_cpu(recall75).item(),
-                "precision": to_cpu(precision).item(),
-                "conf_obj": to_cpu(conf_obj).item(),
-                "conf_noobj": to_cpu(conf_noobj).item(),
-                "grid_size": grid_size,
-            }
+        iou_scores, class_mask, obj_mask, noobj_mask, tx, ty, tw, th, tcls, tconf = build_targets(
+            pred_boxes=pred_boxes,
+            pred_cls=pred_cls,
+            target=targets,
+            anchors=scaled_anchors,
+            ignore_thres=self.ignore_thres,
+        )
 
-            return output, total_loss
+        # Loss : Mask outputs to ignore non-existing objects (except with conf. loss)
+        loss_x = self.mse_loss(x[obj_mask], tx[obj_mask])
+        loss_y = self.mse_loss(y[obj_mask], ty[obj_mask])
+        loss_w = self.mse_loss(w[obj_mask], tw[obj_mask])
+        loss_h = self.mse_loss(h[obj_mask], th[obj_mask])
+        loss_conf_obj = self.bce_loss(pred_conf[obj_mask], tconf[obj_mask])
+        loss_conf_noobj = self.bce_loss(pred_conf[noobj_mask], tconf[noobj_mask])
+        loss_conf = self.obj_scale * loss_conf_obj + self.noobj_scale * loss_conf_noobj
+        loss_cls = self.bce_loss(pred_cls[obj_mask], tcls[obj_mask])
+        total_loss = loss_x + loss_y + loss_w + loss_h + loss_conf + loss_cls
+
+        # Metrics
+        cls_acc = 100 * class_mask[obj_mask].mean()
+        conf_obj = pred_conf[obj_mask].mean()
+        conf_noobj = pred_conf[noobj_mask].mean()
+        conf50 = (pred_conf > 0.5).float()
+        iou50 = (iou_scores > 0.5).float()
+        iou75 = (iou_scores > 0.75).float()
+        detected_mask = conf50 * class_mask * tconf
+        precision = torch.sum(iou50 * detected_mask) / (conf50.sum() + 1e-16)
+        recall50 = torch.sum(iou50 * detected_mask) / (obj_mask.sum() + 1e-16)
+        recall75 = torch.sum(iou75 * detected_mask) / (obj_mask.sum() + 1e-16)
+
+        self.metrics = {
+            "loss": to_cpu(total_loss).item(),
+            "x": to_cpu(loss_x).item(),
+            "y": to_cpu(loss_y).item(),
+            "w": to_cpu(loss_w).item(),
+            "h": to_cpu(loss_h).item(),
+            "conf": to_cpu(loss_conf).item(),
+            "cls": to_cpu(loss_cls).item(),
+            "cls_acc": to_cpu(cls_acc).item(),
+            "recall50": to_cpu(recall50).item(),
+            "recall75": to_cpu(recall75).item(),
+            "precision": to_cpu(precision).item(),
+            "conf_obj": to_cpu(conf_obj).item(),
+            "conf_noobj": to_cpu(conf_noobj).item(),
+            "grid_size": grid_size,
+        }
+
+        return output, total_loss
 
 
 class Darknet(nn.Module):
     """YOLOv3 object detection model"""
 
     def __init__(self, config_path, img_size=416):
+        """'config_path' may also be a list of module definitions as returned by parse_model_config"""
         super(Darknet, self).__init__()
-        self.module_defs = parse_model_config(config_path)
+        if isinstance(config_path, str):
+            self.module_defs = parse_model_config(config_path)
+        else:
+            self.module_defs = [dict(module_def) for module_def in config_path]
         self.hyperparams, self.module_list = create_modules(self.module_defs)
         self.yolo_layers = [layer[0] for layer in self.module_list if hasattr(layer[0], "metrics")]
+        self.plan = self._build_plan()
         self.img_size = img_size
         self.seen = 0
         self.header_info = np.array([0, 0, 0, self.seen, 0], dtype=np.int32)
+        self.fused = False
+        self.channels_last = False
+        self.bf16 = False
 
-    def forward(self, x, targets=None):
+    def set_inference_mode(self, channels_last=False, bf16=False):
+        """
+        Selects the CPU inference path: 'channels_last' converts weights (and inputs in forward)
+        to the channels-last memory format, 'bf16' runs the backbone under CPU bfloat16 autocast.
+        The YOLO decode, and therefore NMS, always run in float32.
+        """
+        self.channels_last = channels_last
+        self.bf16 = bf16
+        self.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+        return self
+
+    def fuse(self):
+        """
+        Folds every batch norm into its convolution for inference.
+        Uses the running statistics, so call it after loading weights; the fused
+        model must not be trained further.
+        """
+        for module_def, module in zip(self.module_defs, self.module_list):
+            # The linear convs feeding YOLO layers have no batch norm, so no second module
+            if module_def["type"] == "convolutional" and len(module) > 1 and isinstance(module[1], nn.BatchNorm2d):
+                conv_name, bn_name = list(module._modules)[:2]
+                module._modules[conv_name] = fuse_conv_and_bn(module[0], module[1])
+                del module._modules[bn_name]
+        self.fused = True
+        return self
+
+    def _build_plan(self):
+        """
+        Precomputes the execution plan of forward: for every layer its op kind, the absolute
+        indices of the stored outputs it reads, whether its own output must be stored for a
+        later route/shortcut, and which stored outputs can be released once it has run.
+        """
+        consumers = []
+        last_use = {}
+        for i, module_def in enumerate(self.module_defs):
+            if module_def["type"] == "route":
+                inputs = [int(layer_i) for layer_i in module_def["layers"].split(",")]
+            elif module_def["type"] == "shortcut":
+                # The other operand is the previous output, which forward already holds in x
+                inputs = [int(module_def["from"])]
+            else:
+                inputs = []
+            inputs = [i + layer_i if layer_i < 0 else layer_i for layer_i in inputs]
+            for layer_i in inputs:
+                last_use[layer_i] = i
+            consumers.append(inputs)
+
+        release = [[] for _ in self.module_defs]
+        for layer_i, i in last_use.items():
+            release[i].append(layer_i)
+
+        return [
+            (module_def["type"], inputs, i in last_use, release[i])
+            for i, (module_def, inputs) in enumerate(zip(self.module_defs, consumers))
+        ]
+
+    def forward(self, x, targets=None, compact=False, to_host=True, conf_thres=None, top_k=None):
+        """
+        Returns the decoded predictions of every YOLO layer (and the loss if 'targets' is given).
+        With 'compact' (inference only) each row is (x, y, w, h, conf, cls_conf, cls_pred),
+        as expected by non_max_suppression(..., compact=True).
+        With 'to_host' False the predictions stay on the model's device, so that only the
+        detections surviving non_max_suppression need to be copied to host memory.
+        With 'conf_thres' (inference only) the YOLO layers decode only rows reaching that object
+        confidence, already in (x1, y1, x2, y2, ...), and a list with the candidates of each image
+        (at most 'top_k' per image) is returned instead; non_max_suppression accepts it directly.
+        """
+        # Input height, the stride is the same along both axes of rectangular inputs
         img_dim = x.shape[2]
+        num_samples = x.size(0)
         loss = 0
-        layer_outputs, yolo_outputs = [], []
-        for i, (module_def, module) in enumerate(zip(self.module_defs, self.module_list)):
-            if module_def["type"] in ["convolutional", "upsample", "maxpool"]:
-                x = module(x)
-            elif module_def["type"] == "route":
-                x = torch.cat([layer_outputs[int(layer_i)] for layer_i in module_def["layers"].split(",")], 1)
-            elif module_def["type"] == "shortcut":
-                layer_i = int(module_def["from"])
-                x = layer_outputs[-1] + layer_outputs[layer_i]
-            elif module_def["type"] == "yolo":
-                x, layer_loss = module[0](x, targets, img_dim)
-                loss += layer_loss
-                yolo_outputs.append(x)
-            layer_outputs.append(x)
-        yolo_outputs = to_cpu(torch.cat(yolo_outputs, 1))
+        layer_outputs, yolo_outputs = {}, []
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        autocast = torch.autocast("cpu", dtype=torch.bfloat16) if self.bf16 and targets is None else nullcontext()
+        with autocast:
+            for i, (module, (kind, inputs, keep, release)) in enumerate(zip(self.module_list, self.plan)):
+                if kind == "route":
+                    if len(inputs) > 1:
+                        x = torch.cat([layer_outputs[layer_i] for layer_i in inputs], 1)
+                    else:
+                        x = layer_outputs[inputs[0]]
+                elif kind == "shortcut":
+                    x = x + layer_outputs[inputs[0]]
+                elif kind == "yolo":
+                    x, layer_loss = module[0](x.float(), targets, img_dim, compact, conf_thres)
+                    # Inference graphs (FX or TorchScript tracing) must not carry the constant zero loss
+                    if targets is not None:
+                        loss += layer_loss
+                    yolo_outputs.append(x)
+                else:
+                    x = module(x)
+                # Drop activations whose last consumer has run
+                for layer_i in release:
+                    del layer_outputs[layer_i]
+                if keep:
+                    layer_outputs[i] = x
+        if targets is None and conf_thres is not None:
+            rows, image_i = [torch.cat(outputs) for outputs in zip(*yolo_outputs)]
+            candidates = split_candidates(rows, image_i, num_samples, top_k)
+            return [to_cpu(rows) for rows in candidates] if to_host else candidates
+        yolo_outputs = torch.cat(yolo_outputs, 1)
+        if to_host:
+            yolo_outputs = to_cpu(yolo_outputs)
         return yolo_outputs if targets is None else (loss, yolo_outputs)
 
-    def load_darknet_weights(self, weights_path):
-        """Parses and loads the weights stored in 'weights_path'"""
+    def _darknet_layout(self, cutoff=None):
+        """
+        Returns the (module_def, module, offset) of every convolutional block before 'cutoff'
+        in a .weights file, and the total number of float32 values those blocks occupy
+        """
+        layout, ptr = [], 0
+        for module_def, module in zip(self.module_defs[:cutoff], self.module_list[:cutoff]):
+            if module_def["type"] == "convolutional":
+                conv_layer = module[0]
+                num_b = conv_layer.out_channels
+                layout.append((module_def, module, ptr))
+                ptr += (4 * num_b if module_def["batch_normalize"] else num_b) + conv_layer.weight.numel()
+        return layout, ptr
+
+    def _load_darknet_block(self, weights, module_def, module, ptr):
+        """Fills one convolutional block from the flat 'weights' array starting at 'ptr'"""
+        conv_layer = module[0]
+        num_b = conv_layer.out_channels  # Number of biases
+        if module_def["batch_normalize"]:
+            # Load BN bias, weights, running mean and running variance
+            # (into a scratch layer that is folded below if the model is fused)
+            bn_layer = nn.BatchNorm2d(num_b, eps=1e-5) if self.fused else module[1]
+            for param in (bn_layer.bias, bn_layer.weight, bn_layer.running_mean, bn_layer.running_var):
+                param.data.copy_(torch.from_numpy(weights[ptr : ptr + num_b]).view_as(param))
+                ptr += num_b
+        else:
+            # Load conv. bias
+            conv_layer.bias.data.copy_(torch.from_numpy(weights[ptr : ptr + num_b]).view_as(conv_layer.bias))
+            ptr += num_b
+        # Load conv. weights
+        num_w = conv_layer.weight.numel()
+        conv_layer.weight.data.copy_(torch.from_numpy(weights[ptr : ptr + num_w]).view_as(conv_layer.weight))
+        if self.fused and module_def["batch_normalize"]:
+            conv_layer.bias.data.zero_()
+            fold_batch_norm(conv_layer, bn_layer.to(conv_layer.weight.device))
+
+    def _darknet_block_values(self, module_def, module):
+        """Returns the arrays of one convolutional block in .weights file order"""
+        conv_layer = module[0]
+        if module_def["batch_normalize"] and self.fused:
+            # Fused blocks are stored as an identity batch norm shifted by the conv bias
+            bias = conv_layer.bias.data.cpu().numpy()
+            values = [bias, np.ones_like(bias), np.zeros_like(bias), np.full_like(bias, 1 - 1e-5)]
+        elif module_def["batch_normalize"]:
+            bn_layer = module[1]
+            values = [
+                bn_layer.bias.data.cpu().numpy(),
+                bn_layer.weight.data.cpu().numpy(),
+                bn_layer.running_mean.data.cpu().numpy(),
+                bn_layer.running_var.data.cpu().numpy(),
+            ]
+        else:
+            values = [conv_layer.bias.data.cpu().numpy()]
+        return values + [conv_layer.weight.data.cpu().numpy()]
+
+    def load_darknet_weights(self, weights_path, num_workers=0):
+        """
+        Parses and loads the weights stored in 'weights_path'.
+        The file is memory-mapped and checked against the parsed cfg before anything is copied;
+        with 'num_workers' > 1 the layers are filled from the map by a thread pool.
+        """
 
         # Open the weights file
         with open(weights_path, "rb") as f:
             header = np.fromfile(f, dtype=np.int32, count=5)  # First five are header values
-            self.header_info = header  # Needed to write header when saving weights
-            self.seen = header[3]  # number of images seen during training
-            weights = np.fromfile(f, dtype=np.float32)  # The rest are weights
+        if header.size != 5:
+            raise ValueError(f"'{weights_path}' is too short to hold a darknet header")
+        self.header_info = header  # Needed to write header when saving weights
+        self.seen = header[3]  # number of images seen during training
 
         # Establish cutoff for loading backbone weights
         cutoff = None
         if "darknet53.conv.74" in weights_path:
             cutoff = 75
 
-        ptr = 0
-        for i, (module_def, module) in enumerate(zip(self.module_defs, self.module_list)):
-            if i == cutoff:
-                break
-            if module_def["type"] == "convolutional":
-                conv_layer = module[0]
-                if module_def["batch_normalize"]:
-                    # Load BN bias, weights, running mean and running variance
-                    bn_layer = module[1]
-                    num_b = bn_layer.bias.numel()  # Number of biases
-                    # Bias
-                    bn_b = torch.from_numpy(weights[ptr : ptr + num_b]).view_as(bn_layer.bias)
-                    bn_layer.bias.data.copy_(bn_b)
-                    ptr += num_b
-                    # Weight
-                    bn_w = torch.from_numpy(weights[ptr : ptr + num_b]).view_as(bn_layer.weight)
-                    bn_layer.weight.data.copy_(bn_w)
-                    ptr += num_b
-                    # Running Mean
-                    bn_rm = torch.from_numpy(weights[ptr : ptr + num_b]).view_as(bn_layer.running_mean)
-                    bn_layer.running_mean.data.copy_(bn_rm)
-                    ptr += num_b
-                    # Running Var
-                    bn_rv = torch.from_numpy(weights[ptr : ptr + num_b]).view_as(bn_layer.running_var)
-                    bn_layer.running_var.data.copy_(bn_rv)
-                    ptr += num_b
-                else:
-                    # Load conv. bias
-                    num_b = conv_layer.bias.numel()
-                    conv_b = torch.from_numpy(weights[ptr : ptr + num_b]).view_as(conv_layer.bias)
-                    conv_layer.bias.data.copy_(conv_b)
-                    ptr += num_b
-                # Load conv. weights
-                num_w = conv_layer.weight.numel()
-                conv_w = torch.from_numpy(weights[ptr : ptr + num_w]).view_as(conv_layer.weight)
-                conv_layer.weight.data.copy_(conv_w)
-                ptr += num_w
+        layout, num_values = self._darknet_layout(cutoff)
+        num_available = (os.path.getsize(weights_path) - header.nbytes) // 4
+        if num_available < num_values or (cutoff is None and num_available != num_values):
+            raise ValueError(
+                f"'{weights_path}' holds {num_available} weights but the model definition expects {num_values}"
+            )
+
+        # Copy-on-write map, so parameters can be filled from writable views without reading the file up front
+        weights = np.memmap(weights_path, dtype=np.float32, mode="c", offset=header.nbytes, shape=(num_values,))
+        if num_workers > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as pool:
+                list(pool.map(lambda block: self._load_darknet_block(weights, *block), layout))
+        else:
+            for block in layout:
+                self._load_darknet_block(weights, *block)
+        del weights
 
     def save_darknet_weights(self, path, cutoff=-1):
         """
             @:param path    - path of the new weights file
             @:param cutoff  - save layers between 0 and cutoff (cutoff = -1 -> all are saved)
         """
-        fp = open(path, "wb")
         self.header_info[3] = self.seen
-        self.header_info.tofile(fp)
 
-        # Iterate through layers
-        for i, (module_def, module) in enumerate(zip(self.module_defs[:cutoff], self.module_list[:cutoff])):
-            if module_def["type"] == "convolutional":
-                conv_layer = module[0]
-                # If batch norm, load bn first
-                if module_def["batch_normalize"]:
-                    bn_layer = module[1]
-                    bn_layer.bias.data.cpu().numpy().tofile(fp)
-                    bn_layer.weight.data.cpu().numpy().tofile(fp)
-                    bn_layer.running_mean.data.cpu().numpy().tofile(fp)
-                    bn_layer.running_var.data.cpu().numpy().tofile(fp)
-                # Load conv bias
-                else:
-                    conv_layer.bias.data.cpu().numpy().tofile(fp)
-                # Load conv weights
-                conv_layer.weight.data.cpu().numpy().tofile(fp)
+        # Gather every layer into one contiguous buffer and write it at once
+        layout, num_values = self._darknet_layout(cutoff)
+        weights = np.empty(num_values, dtype=np.float32)
+        for module_def, module, ptr in layout:
+            for values in self._darknet_block_values(module_def, module):
+                weights[ptr : ptr + values.size] = values.ravel()
+                ptr += values.size
+
+        with open(path, "wb") as fp:
+            self.header_info.tofile(fp)
+            weights.tofile(fp)
+
+    def save_packed(self, path, class_names=None, cfg_hash=None):
+        """
+        Writes a single-file inference artifact: module definitions, weights (fused if the model
+        is), class names, input size and cfg hash, loadable with Darknet.load_packed
+        """
+        tensors, arrays, size = [], [], 0
+        for name, tensor in self.state_dict().items():
+            array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+            offset = -(-size // PACK_ALIGN) * PACK_ALIGN
+            tensors.append([name, list(array.shape), array.dtype.str, offset])
+            arrays.append((offset, array))
+            size = offset + array.nbytes
+
+        header = json.dumps(
+            {
+                "module_defs": [self.hyperparams] + self.module_defs,
+                "fused": self.fused,
+                "class_names": class_names,
+                "img_size": self.img_size,
+                "cfg_hash": cfg_hash,
+                "seen": int(self.seen),
+                "tensors": tensors,
+            }
+        ).encode("utf-8")
+        data_offset = -(-(16 + len(header)) // PACK_ALIGN) * PACK_ALIGN
+
+        buffer = np.zeros(data_offset + size, dtype=np.uint8)
+        buffer[:8] = np.frombuffer(PACK_MAGIC, dtype=np.uint8)
+        buffer[8:16] = np.frombuffer(len(header).to_bytes(8, "little"), dtype=np.uint8)
+        buffer[16 : 16 + len(header)] = np.frombuffer(header, dtype=np.uint8)
+        for offset, array in arrays:
+            buffer[data_offset + offset : data_offset + offset + array.nbytes] = array.reshape(-1).view(np.uint8)
+        buffer.tofile(path)
+
+    @classmethod
+    def load_packed(cls, path, cfg_hash=None):
+        """
+        Builds a model from an artifact written by save_packed, without parsing a cfg or randomly
+        initializing layers, reading the whole file at once. If 'cfg_hash' is given it must
+        match the hash stored at export time.
+        """
+        data = np.fromfile(path, dtype=np.uint8)
+        if data[:8].tobytes() != PACK_MAGIC:
+            raise ValueError(f"'{path}' is not a packed model")
+        header_len = int.from_bytes(data[8:16].tobytes(), "little")
+        header = json.loads(data[16 : 16 + header_len].tobytes().decode("utf-8"))
+        if cfg_hash is not None and header["cfg_hash"] != cfg_hash:
+            raise ValueError(f"'{path}' was exported from a different model definition")
+        data_offset = -(-(16 + header_len) // PACK_ALIGN) * PACK_ALIGN
+
+        # Fused convs are built inside the block too, their weights come from the artifact
+        with skip_init():
+            model = cls(header["module_defs"], img_size=header["img_size"])
+            if header["fused"]:
+                model.fuse()
+
+        state_dict = {}
+        for name, shape, dtype, offset in header["tensors"]:
+            dtype = np.dtype(dtype)
+            start = data_offset + offset
+            end = start + int(np.prod(shape)) * dtype.itemsize
+            state_dict[name] = torch.from_numpy(data[start:end].view(dtype).reshape(shape))
+        model.load_state_dict(state_dict)
+
+        model.seen = header["seen"]
+        model.class_names = header["class_names"]
+        model.cfg_hash = header["cfg_hash"]
+        return model.eval()
+
+
+class DarknetInference(nn.Module):
+    """
+    Stateless inference wrapper taking only the input tensor, with the output options fixed
+    at construction, so the model can be traced into TorchScript or exported to ONNX
+    """
+
+    def __init__(self, model, compact=False):
+        super(DarknetInference, self).__init__()
+        self.model = model
+        self.compact = compact
+
+    def forward(self, x):
+        return self.model(x, compact=self.compact, to_host=False)
+
+
+class OnnxModel(object):
+    """
+    Runs a model exported with export.py --format onnx through onnxruntime's CPU provider.
+    Called like Darknet at inference, returning host tensors accepted by non_max_suppression.
+    """
+
+    def __init__(self, path, num_threads=0):
+        import onnxruntime
 
-        fp.close()
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x, compact=False, to_host=True, conf_thres=None, top_k=None):
+        outputs = self.session.run(None, {self.input_name: to_cpu(x).numpy()})[0]
+        outputs = torch.from_numpy(outputs)
+        if compact:
+            outputs = compact_predictions(outputs)
+        return outputs if conf_thres is None else select_candidates(outputs, conf_thres, top_k)
+
+
+class ExportedModel(nn.Module):
+    """
+    Gives a module that maps an input batch to decoded predictions (a TorchScript or quantized
+    model) the inference call signature of Darknet. 'compact' tells whether the module already
+    emits compact rows.
+    """
+
+    def __init__(self, module, compact=False):
+        super(ExportedModel, self).__init__()
+        self.module = module
+        self.compact = compact
+
+    def forward(self, x, compact=False, to_host=True, conf_thres=None, top_k=None):
+        outputs = self.module(x)
+        if compact and not self.compact:
+            outputs = compact_predictions(outputs)
+        elif self.compact and not compact:
+            raise ValueError("The exported model only produces compact predictions")
+        if to_host:
+            outputs = to_cpu(outputs)
+        return outputs if conf_thres is None else select_candidates(outputs, conf_thres, top_k)
+
+
+def load_inference_model(config_path, weights_path, img_size=416, device="cpu", channels_last=False, bf16=False):
+    """
+    Returns a fused model in evaluation mode, loaded from a packed artifact (.pack), a TorchScript
+    module exported without --compact (.torchscript), or built from 'config_path' and darknet
+    weights or a checkpoint (.pth). 'channels_last' and 'bf16' select the Darknet CPU inference
+    path (see Darknet.set_inference_mode).
+    """
+    if weights_path.endswith(".torchscript"):
+        return ExportedModel(torch.jit.load(weights_path, map_location=device)).eval()
+    elif weights_path.endswith(".pack"):
+        model = Darknet.load_packed(weights_path)
+    else:
+        model = Darknet(config_path, img_size=img_size)
+        if weights_path.endswith(".weights"):
+            model.load_darknet_weights(weights_path)
+        else:
+            model.load_state_dict(torch.load(weights_path, map_location="cpu"))
+    model.eval()
+    if not model.fused:
+        model.fuse()
+    return model.to(device).set_inference_mode(channels_last, bf16)
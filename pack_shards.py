@@ -0,0 +1,85 @@
+from __future__ import division
+
+from utils.datasets import *
+
+import os
+import json
+import argparse
+import tqdm
+
+import numpy as np
+
+
+class ShardWriter(object):
+    """Writes the records of one shard, see ShardDataset for the layout"""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = open(path + ".bin", "wb")
+        self.offset = 0
+        self.records, self.labels, self.img_paths = [], [], []
+        self.num_labels = 0
+
+    def add(self, img_path, data, h, w, boxes):
+        label_count = -1 if boxes is None else len(boxes)
+        self.records.append([self.offset, len(data), self.num_labels, label_count, h, w])
+        if boxes is not None:
+            self.labels.append(boxes)
+            self.num_labels += len(boxes)
+        self.img_paths.append(img_path)
+        self.data.write(data)
+        self.offset += len(data)
+
+    def close(self):
+        self.data.close()
+        np.save(self.path + ".index.npy", np.array(self.records, dtype=np.int64).reshape(-1, 6))
+        np.save(self.path + ".labels.npy", np.concatenate(self.labels, 0) if self.labels else np.zeros((0, 5)))
+        with open(self.path + ".paths", "w") as f:
+            f.write("".join(img_path + "\n" for img_path in self.img_paths))
+        return len(self.records)
+
+
+def encode_image(img_path, img_size=None):
+    """Returns the record data of an image and its original height and width"""
+    if img_size is None:
+        with open(img_path, "rb") as f:
+            data = f.read()
+        w, h = Image.open(io.BytesIO(data)).size
+        return data, h, w
+    img = np.asarray(Image.open(img_path).convert("RGB"))
+    h, w = img.shape[:2]
+    img, _ = letterbox_tensor(img, img_size)
+    return img.numpy().tobytes(), h, w
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--list_path", type=str, required=True, help="image list in ListDataset format")
+    parser.add_argument("--output_dir", type=str, required=True, help="directory of the shards")
+    parser.add_argument("--shard_size", type=int, default=8192, help="number of images per shard")
+    parser.add_argument("--img_size", type=int, help="store images letterboxed to this size (raw uint8)")
+    opt = parser.parse_args()
+    print(opt)
+
+    os.makedirs(opt.output_dir, exist_ok=True)
+    with open(opt.list_path, "r") as file:
+        img_files = [path.rstrip() for path in file.readlines()]
+    label_files = [
+        path.replace("images", "labels").replace(".png", ".txt").replace(".jpg", ".txt") for path in img_files
+    ]
+    label_index = LabelIndex(opt.list_path, label_files)
+
+    shards, writer = [], None
+    for i, img_path in enumerate(tqdm.tqdm(img_files, desc="Packing")):
+        if i % opt.shard_size == 0:
+            if writer is not None:
+                shards.append({"name": os.path.basename(writer.path), "count": writer.close()})
+            writer = ShardWriter(os.path.join(opt.output_dir, "shard-%05d" % (i // opt.shard_size)))
+        data, h, w = encode_image(img_path, opt.img_size)
+        writer.add(img_path, data, h, w, label_index[i])
+    if writer is not None:
+        shards.append({"name": os.path.basename(writer.path), "count": writer.close()})
+
+    with open(os.path.join(opt.output_dir, SHARD_INDEX), "w") as f:
+        json.dump({"img_size": opt.img_size, "shards": shards}, f)
+    print(f"Packed {len(img_files)} images into {len(shards)} shards in {opt.output_dir}")
@@ -0,0 +1,118 @@
+from __future__ import division
+
+from models import *
+from utils.utils import *
+from utils.datasets import *
+from utils.parse_config import *
+from test import evaluate
+
+from terminaltables import AsciiTable
+
+import argparse
+import tqdm
+
+import torch
+from torch.utils.data import DataLoader
+
+
+def calibrate(model, path, img_size, batch_size, num_batches, n_cpu=0):
+    """Runs images listed in 'path' (ListDataset format) through a prepared model to collect activation ranges"""
+    dataset = ListDataset(path, img_size=img_size, augment=False, multiscale=False)
+    dataloader = DataLoader(
+        dataset, batch_size=batch_size, shuffle=False, num_workers=n_cpu, collate_fn=dataset.collate_fn
+    )
+    with torch.no_grad():
+        for batch_i, (_, imgs, _) in enumerate(tqdm.tqdm(dataloader, desc="Calibrating", total=num_batches)):
+            if batch_i == num_batches:
+                break
+            model(imgs)
+
+
+def quantize(model, calib_path, img_size, batch_size=8, num_batches=32, n_cpu=0, backend=None):
+    """
+    Statically quantizes a float CPU model to INT8 with FX graph mode: conv/bn/leaky blocks and
+    shortcuts run quantized, the YOLO decode and the concatenations stay in float32.
+    Returns the converted module, which maps an input batch to full predictions.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    backend = backend or torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    # A quantized final concatenation would share one scale between pixel boxes and [0, 1]
+    # confidences, rounding every confidence to 0; route concatenations go float with it
+    qconfig_mapping = (
+        get_default_qconfig_mapping(backend).set_object_type(YOLOLayer, None).set_object_type(torch.cat, None)
+    )
+    prepare_custom_config = PrepareCustomConfig().set_non_traceable_module_classes([YOLOLayer])
+
+    example_inputs = (torch.zeros(1, 3, img_size, img_size),)
+    prepared = prepare_fx(
+        DarknetInference(model).eval(),
+        qconfig_mapping,
+        example_inputs,
+        prepare_custom_config=prepare_custom_config,
+    )
+    calibrate(prepared, calib_path, img_size, batch_size, num_batches, n_cpu)
+    return convert_fx(prepared)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_def", type=str, default="config/pchar-tiny.cfg", help="path to model definition file")
+    parser.add_argument("--weights_path", type=str, default="weights/pchar-tiny.weights", help="path to weights file")
+    parser.add_argument("--data_config", type=str, default="config/pchar.data", help="path to data config file")
+    parser.add_argument("--calib_path", type=str, help="calibration image list (defaults to the train list)")
+    parser.add_argument("--num_calib_batches", type=int, default=32, help="number of calibration batches")
+    parser.add_argument("--batch_size", type=int, default=8, help="size of each image batch")
+    parser.add_argument("--iou_thres", type=float, default=0.5, help="iou threshold required to qualify as detected")
+    parser.add_argument("--conf_thres", type=float, default=0.001, help="object confidence threshold")
+    parser.add_argument("--nms_thres", type=float, default=0.5, help="iou thresshold for non-maximum suppression")
+    parser.add_argument("--n_cpu", type=int, default=0, help="number of cpu threads to use during batch generation")
+    parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
+    parser.add_argument("--output", type=str, help="path of the quantized TorchScript model")
+    opt = parser.parse_args()
+    print(opt)
+
+    data_config = parse_data_config(opt.data_config)
+    valid_path = data_config["valid"]
+    calib_path = opt.calib_path or data_config["train"]
+    class_names = load_classes(data_config["names"])
+    output = opt.output or os.path.splitext(opt.weights_path)[0] + "-int8.torchscript"
+
+    # Quantized kernels are CPU only, so the float baseline is measured there too
+    model = load_inference_model(opt.model_def, opt.weights_path, img_size=opt.img_size, device="cpu")
+
+    def compute_map(model):
+        return evaluate(
+            model,
+            path=valid_path,
+            iou_thres=opt.iou_thres,
+            conf_thres=opt.conf_thres,
+            nms_thres=opt.nms_thres,
+            img_size=opt.img_size,
+            batch_size=opt.batch_size,
+            device="cpu",
+        )
+
+    print("Compute float32 mAP...")
+    _, _, float_AP, _, float_class = compute_map(model)
+
+    quantized = quantize(model, calib_path, opt.img_size, opt.batch_size, opt.num_calib_batches, opt.n_cpu)
+    with torch.no_grad():
+        scripted = torch.jit.trace(quantized, torch.zeros(1, 3, opt.img_size, opt.img_size))
+    torch.jit.save(scripted, output)
+    print(f"Saved quantized model to {output}")
+
+    print("Compute int8 mAP...")
+    _, _, int8_AP, _, int8_class = compute_map(ExportedModel(quantized))
+
+    float_ap = dict(zip(float_class, float_AP))
+    int8_ap = dict(zip(int8_class, int8_AP))
+    ap_table = [["Index", "Class name", "AP float32", "AP int8"]]
+    for c in sorted(set(float_ap) | set(int8_ap)):
+        ap_table += [[c, class_names[c], "%.5f" % float_ap.get(c, 0), "%.5f" % int8_ap.get(c, 0)]]
+    ap_table += [["", "mAP", "%.5f" % float_AP.mean(), "%.5f" % int8_AP.mean()]]
+    print(AsciiTable(ap_table).table)
+    print(f"---- int8 mAP delta {int8_AP.mean() - float_AP.mean():+.5f}")
@@ -0,0 +1,59 @@
+from __future__ import division
+
+from utils.utils import *
+from utils.prediction_cache import PredictionCache, model_key
+
+from terminaltables import AsciiTable
+
+import argparse
+import itertools
+import tqdm
+
+
+def evaluate_cached(cache, iou_thres, conf_thres, nms_thres, batch_size=256):
+    """Runs NMS and the mAP evaluation over cached candidates, returns precision, recall, AP, f1 and the classes"""
+    evaluator = DetectionEvaluator(num_thresholds=np.size(iou_thres))
+    for start in range(0, len(cache), batch_size):
+        candidates, targets = cache.batch(range(start, min(start + batch_size, len(cache))))
+        outputs = non_max_suppression(candidates, conf_thres=conf_thres, nms_thres=nms_thres, compact=True)
+        evaluator.update(get_batch_statistics(outputs, targets, iou_threshold=iou_thres), targets[:, 1].numpy())
+    return evaluator.compute()
+
+
+def parse_grid(values):
+    return [float(value) for value in values.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_def", type=str, default="config/yolov3.cfg", help="path to model definition file")
+    parser.add_argument("--weights_path", type=str, default="weights/yolov3.weights", help="path to weights file")
+    parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
+    parser.add_argument("--cache_dir", type=str, required=True, help="directory given to test.py --cache_dir")
+    parser.add_argument("--cache_floor", type=float, default=0.001, help="confidence floor the cache was written with")
+    parser.add_argument("--conf_grid", type=str, default="0.001,0.01,0.1,0.3,0.5,0.7,0.8", help="object confidence thresholds")
+    parser.add_argument("--nms_grid", type=str, default="0.3,0.4,0.5,0.6", help="iou thresholds for non-maximum suppression")
+    parser.add_argument("--iou_thres", type=float, default=0.5, help="iou threshold required to qualify as detected")
+    parser.add_argument("--batch_size", type=int, default=256, help="number of images post-processed at once")
+    opt = parser.parse_args()
+    print(opt)
+
+    cache = PredictionCache(opt.cache_dir, model_key(opt.model_def, opt.weights_path, opt.img_size, opt.cache_floor))
+    print(f"Loaded cached predictions of {len(cache)} images from {cache.path}")
+
+    conf_grid = parse_grid(opt.conf_grid)
+    if min(conf_grid) < cache.floor:
+        print(f"Warning: confidence thresholds below the cache floor {cache.floor} miss candidates")
+
+    results = []
+    for conf_thres, nms_thres in tqdm.tqdm(list(itertools.product(conf_grid, parse_grid(opt.nms_grid))), desc="Sweeping"):
+        precision, recall, AP, f1, ap_class = evaluate_cached(cache, opt.iou_thres, conf_thres, nms_thres, opt.batch_size)
+        results.append((conf_thres, nms_thres, precision.mean(), recall.mean(), f1.mean(), AP.mean()))
+
+    sweep_table = [["conf_thres", "nms_thres", "precision", "recall", "f1", "mAP"]]
+    for result in results:
+        sweep_table += [["%g" % result[0], "%g" % result[1]] + ["%.5f" % value for value in result[2:]]]
+    print(AsciiTable(sweep_table).table)
+
+    best = max(results, key=lambda result: result[-1])
+    print(f"Best mAP {best[-1]:.5f} at conf_thres {best[0]:g}, nms_thres {best[1]:g}")
@@ -4,6 +4,7 @@ from models import *
 from utils.utils import *
 from utils.datasets import *
 from utils.parse_config import *
+from utils.prediction_cache import PredictionCacheWriter, model_key
 
 import os
 import sys
@@ -12,6 +13,8 @@ import datetime
 import argparse
 import tqdm
 
+from terminaltables import AsciiTable
+
 import torch
 from torch.utils.data import DataLoader
 from torchvision import datasets
@@ -20,40 +23,90 @@ from torch.autograd import Variable
 import torch.optim as optim
 
 
-def evaluate(model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size):
+_eval_loaders = {}
+
+
+def eval_loader(path, img_size, batch_size, cache_images=None, rect=False, num_workers=1, device="cpu"):
+    """Returns the evaluation DataLoader of a dataset, built once with persistent workers"""
+    key = (path, img_size, batch_size, cache_images, rect, num_workers, torch.device(device).type)
+    if key not in _eval_loaders:
+        dataset = load_dataset(path, img_size=img_size, augment=False, multiscale=False, cache_images=cache_images)
+        if isinstance(dataset, ListDataset):
+            loader_args = dict(batch_sampler=make_batch_sampler(dataset, batch_size, rect=rect))
+        elif rect:
+            raise ValueError("Rectangular batches need an image list, not %s" % path)
+        else:
+            loader_args = dict(batch_size=batch_size)
+        _eval_loaders[key] = torch.utils.data.DataLoader(
+            dataset,
+            num_workers=num_workers,
+            pin_memory=torch.device(device).type == "cuda",
+            persistent_workers=num_workers > 0,
+            collate_fn=dataset.collate_fn,
+            **loader_args,
+        )
+    return _eval_loaders[key]
+
+
+def evaluate(
+    model,
+    path,
+    iou_thres,
+    conf_thres,
+    nms_thres,
+    img_size,
+    batch_size,
+    device=None,
+    log_interval=0,
+    cache=None,
+    cache_images=None,
+    rect=False,
+    num_workers=1,
+):
+    """
+    Computes precision, recall, AP, f1 and the evaluated classes on the list file or shard
+    directory 'path'. When 'iou_thres' is a sequence of T thresholds they are all matched in one
+    pass and each metric has a T column. With a PredictionCacheWriter 'cache' the pre-NMS
+    candidates above its floor are stored for later threshold sweeps. 'cache_images' is passed
+    on to ListDataset; with 'rect' a list is batched by aspect ratio into rectangular inputs.
+    The loader and its workers are kept for later evaluations of the same data.
+    """
     model.eval()
 
-    # Get dataloader
-    dataset = ListDataset(path, img_size=img_size, augment=False, multiscale=False)
-    dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=batch_size, shuffle=False, num_workers=1, collate_fn=dataset.collate_fn
-    )
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
+    dataloader = eval_loader(path, img_size, batch_size, cache_images, rect, num_workers, device)
 
-    labels = []
-    sample_metrics = []  # List of tuples (TP, confs, pred)
-    for batch_i, (_, imgs, targets) in enumerate(tqdm.tqdm(dataloader, desc="Detecting objects")):
+    evaluator = DetectionEvaluator(num_thresholds=np.size(iou_thres))
+    # Images are copied to the device ahead of use, targets stay on the host for the statistics
+    prefetcher = DataPrefetcher(dataloader, device, move_targets=False)
+    progress = tqdm.tqdm(prefetcher, desc="Detecting objects")
+    decode_thres = conf_thres if cache is None else min(conf_thres, cache.floor)
+    for batch_i, (img_paths, imgs, targets) in enumerate(progress):
 
         # Extract labels
-        labels += targets[:, 1].tolist()
+        labels = targets[:, 1].numpy().copy()
         # Rescale target
         targets[:, 2:] = xywh2xyxy(targets[:, 2:])
-        targets[:, 2:] *= img_size
-
-        imgs = Variable(imgs.type(Tensor), requires_grad=False)
+        height, width = imgs.shape[-2:]
+        targets[:, 2:] *= targets.new_tensor([width, height, width, height])
 
         with torch.no_grad():
-            outputs = model(imgs)
-            outputs = non_max_suppression(outputs, conf_thres=conf_thres, nms_thres=nms_thres)
+            outputs = model(imgs, compact=True, to_host=False, conf_thres=decode_thres)
+            if cache is not None:
+                cache.add(img_paths, outputs, targets)
+            outputs = non_max_suppression(outputs, conf_thres=conf_thres, nms_thres=nms_thres, compact=True)
+            outputs = [output if output is None else to_cpu(output) for output in outputs]
 
-        sample_metrics += get_batch_statistics(outputs, targets, iou_threshold=iou_thres)
+        evaluator.update(get_batch_statistics(outputs, targets, iou_threshold=iou_thres), labels)
 
-    # Concatenate sample statistics
-    true_positives, pred_scores, pred_labels = [np.concatenate(x, 0) for x in list(zip(*sample_metrics))]
-    precision, recall, AP, f1, ap_class = ap_per_class(true_positives, pred_scores, pred_labels, labels)
+        # Running mAP every 'log_interval' batches
+        if log_interval and (batch_i + 1) % log_interval == 0:
+            progress.set_postfix(mAP="%.4f" % evaluator.compute()[2].mean(0).flat[0])
 
-    return precision, recall, AP, f1, ap_class
+    print(prefetcher.summary())
+    return evaluator.compute()
 
 
 if __name__ == "__main__":
@@ -64,10 +117,16 @@ if __name__ == "__main__":
     parser.add_argument("--weights_path", type=str, default="weights/yolov3.weights", help="path to weights file")
     parser.add_argument("--class_path", type=str, default="data/coco.names", help="path to class label file")
     parser.add_argument("--iou_thres", type=float, default=0.5, help="iou threshold required to qualify as detected")
+    parser.add_argument("--iou_sweep", action="store_true", help="report AP@.5, AP@.75 and AP@.5:.95 in one pass")
     parser.add_argument("--conf_thres", type=float, default=0.001, help="object confidence threshold")
     parser.add_argument("--nms_thres", type=float, default=0.5, help="iou thresshold for non-maximum suppression")
     parser.add_argument("--n_cpu", type=int, default=8, help="number of cpu threads to use during batch generation")
     parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
+    parser.add_argument("--cache_dir", type=str, help="directory to store pre-NMS predictions in for sweep.py")
+    parser.add_argument("--cache_floor", type=float, default=0.001, help="lowest object confidence kept in the cache")
+    parser.add_argument("--cache_images", choices=["ram", "disk"], help="keep decoded images in RAM or on disk")
+    parser.add_argument("--rect", action="store_true", help="batch images by aspect ratio into rectangular inputs")
+    parser.add_argument("--log_interval", type=int, default=0, help="interval (batches) between running mAP updates")
     opt = parser.parse_args()
     print(opt)
 
@@ -86,20 +145,42 @@ if __name__ == "__main__":
         # Load checkpoint weights
         model.load_state_dict(torch.load(opt.weights_path))
 
+    cache = None
+    if opt.cache_dir:
+        key = model_key(opt.model_def, opt.weights_path, opt.img_size, opt.cache_floor)
+        cache = PredictionCacheWriter(opt.cache_dir, key, opt.cache_floor, opt.img_size)
+        print(f"Caching predictions in {cache.path}")
+
     print("Compute mAP...")
 
     precision, recall, AP, f1, ap_class = evaluate(
         model,
         path=valid_path,
-        iou_thres=opt.iou_thres,
+        iou_thres=coco_iou_thresholds() if opt.iou_sweep else opt.iou_thres,
         conf_thres=opt.conf_thres,
         nms_thres=opt.nms_thres,
         img_size=opt.img_size,
         batch_size=8,
+        log_interval=opt.log_interval,
+        cache=cache,
+        cache_images=opt.cache_images,
+        rect=opt.rect,
+        num_workers=opt.n_cpu,
     )
+    if cache is not None:
+        cache.close()
+
+    if opt.iou_sweep:
+        # Columns follow coco_iou_thresholds: 0 is IoU 0.5 and 5 is IoU 0.75
+        ap_table = [["Index", "Class name", "AP@.5", "AP@.75", "AP@.5:.95"]]
+        for i, c in enumerate(ap_class):
+            ap_table += [[c, class_names[c], "%.5f" % AP[i, 0], "%.5f" % AP[i, 5], "%.5f" % AP[i].mean()]]
+        mean_AP = AP.mean(0)
+        ap_table += [["", "mAP", "%.5f" % mean_AP[0], "%.5f" % mean_AP[5], "%.5f" % mean_AP.mean()]]
+        print(AsciiTable(ap_table).table)
+    else:
+        print("Average Precisions:")
+        for i, c in enumerate(ap_class):
+            print(f"+ Class '{c}' ({class_names[c]}) - AP: {AP[i]}")
 
-    print("Average Precisions:")
-    for i, c in enumerate(ap_class):
-        print(f"+ Class '{c}' ({class_names[c]}) - AP: {AP[i]}")
-
-    print(f"mAP: {AP.mean()}")
+        print(f"mAP: {AP.mean()}")
@@ -0,0 +1,19 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from utils.augmentations import BatchAugmentation
+from utils.parse_config import parse_model_config
+
+
+@pytest.mark.parametrize("config_path", ["config/pchar.cfg", "config/pchar-tiny.cfg"])
+def test_char_configs_do_not_flip(config_path):
+    hyperparams = parse_model_config(config_path)[0]
+    augmenter = BatchAugmentation.from_hyperparams(hyperparams)
+    assert augmenter.flip == 0
+    assert augmenter.saturation == 1.5 and augmenter.exposure == 1.5 and augmenter.hue == 0.1
+
+
+def test_flip_follows_config():
+    assert BatchAugmentation.from_hyperparams({"flip": "1"}).flip == 0.5
+    assert BatchAugmentation.from_hyperparams({"flip": "0"}).flip == 0
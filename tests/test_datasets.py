@@ -0,0 +1,78 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+from utils.datasets import letterbox, square_targets
+from utils.utils import letterbox_geometry, rescale_boxes
+
+
+def test_square_targets_follow_letterbox():
+    # A white box on a plate-shaped image
+    h, w, size = 96, 420, 416
+    img = np.zeros((h, w, 3), dtype=np.uint8)
+    img[30:70, 100:300] = 255
+    boxes = np.array([[0, 200 / w, 50 / h, 200 / w, 40 / h]])
+
+    out, geometry = letterbox(img, size)
+    targets = square_targets(boxes, h, w, size)
+    ys, xs = np.nonzero(out[..., 0])
+    x1, y1, x2, y2 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+    _, _, x, y, box_w, box_h = (targets[0] * torch.tensor([1, 1, size, size, size, size])).tolist()
+    # Exactly the box through the letterbox geometry, and within nearest-neighbour resampling of the pixels
+    scale_x, scale_y, pad_x, pad_y = geometry
+    expected = [100 * scale_x + pad_x, 30 * scale_y + pad_y, 300 * scale_x + pad_x, 70 * scale_y + pad_y]
+    actual = [x - box_w / 2, y - box_h / 2, x + box_w / 2, y + box_h / 2]
+    assert max(abs(a - e) for a, e in zip(actual, expected)) < 1e-4
+    assert max(abs(a - p) for a, p in zip(actual, (x1, y1, x2, y2))) <= 1
+
+    detections = torch.tensor([[x - box_w / 2, y - box_h / 2, x + box_w / 2, y + box_h / 2]])
+    rescaled = rescale_boxes(detections, size, (h, w), letterbox_geometry((h, w), size))
+    torch.testing.assert_close(rescaled, torch.tensor([[100.0, 30.0, 300.0, 70.0]]), rtol=0, atol=1e-3)
+
+
+def pack(tmp_path, shapes, shard_size=2):
+    """Packs gray images of 'shapes' with one box each into shards, returns the shard directory"""
+    import json
+    from PIL import Image
+
+    from pack_shards import ShardWriter, encode_image
+    from utils.datasets import SHARD_INDEX
+
+    shards, writer = [], None
+    for i, (h, w) in enumerate(shapes):
+        if i % shard_size == 0:
+            if writer is not None:
+                shards.append({"name": "shard-%05d" % (i // shard_size - 1), "count": writer.close()})
+            writer = ShardWriter(str(tmp_path / ("shard-%05d" % (i // shard_size))))
+        img_path = str(tmp_path / ("%d.png" % i))
+        Image.fromarray(np.full((h, w, 3), 128, dtype=np.uint8)).save(img_path)
+        data, h, w = encode_image(img_path)
+        writer.add(img_path, data, h, w, np.array([[0, 0.5, 0.5, 0.25, 0.25]]))
+    shards.append({"name": "shard-%05d" % ((len(shapes) - 1) // shard_size), "count": writer.close()})
+    with open(str(tmp_path / SHARD_INDEX), "w") as f:
+        json.dump({"img_size": None, "shards": shards}, f)
+    return str(tmp_path)
+
+
+def test_collate_shard_batch(tmp_path):
+    from utils.datasets import ShardDataset
+
+    dataset = ShardDataset(pack(tmp_path, [(48, 64), (64, 40)]), img_size=64, augment=False, multiscale=False)
+    paths, imgs, targets = dataset.collate_fn(list(dataset))
+    assert len(paths) == 2
+    assert imgs.shape == (2, 3, 64, 64) and imgs.dtype == torch.float32
+    assert targets[:, 0].tolist() == [0, 1]
+
+
+def test_shard_workers_share_multiscale_schedule(tmp_path):
+    from torch.utils.data import DataLoader
+
+    from utils.datasets import ShardDataset
+
+    dataset = ShardDataset(pack(tmp_path, [(48, 64)] * 4), img_size=128, augment=False, multiscale=True)
+    loader = DataLoader(dataset, batch_size=1, num_workers=2, collate_fn=dataset.collate_fn)
+    # All four batches fall into the first interval of the schedule, whichever worker loads them
+    sizes = {tuple(imgs.shape[-2:]) for _, imgs, _ in loader}
+    assert len(sizes) == 1
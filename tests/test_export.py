@@ -0,0 +1,39 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from export import check_parity, export_torchscript
+from models import Darknet, load_inference_model
+
+SHIPPED_CONFIGS = ["config/plate-tiny.cfg", "config/pchar-tiny.cfg", "config/pchar.cfg"]
+
+
+def fused_model(config_path, img_size=128):
+    torch.manual_seed(0)
+    return Darknet(config_path, img_size=img_size).eval().fuse()
+
+
+@pytest.mark.parametrize("config_path", SHIPPED_CONFIGS)
+def test_torchscript_roundtrip(config_path, tmp_path):
+    model = fused_model(config_path)
+    path = str(tmp_path / "model.torchscript")
+    export_torchscript(model, path, 128)
+
+    check_parity(model, torch.jit.load(path), 128)
+    loaded = load_inference_model(config_path, path)
+    imgs = torch.rand(2, 3, 128, 128)
+    with torch.no_grad():
+        torch.testing.assert_close(loaded(imgs), model(imgs), rtol=1e-3, atol=1e-3)
+
+
+@pytest.mark.parametrize("config_path", SHIPPED_CONFIGS)
+def test_onnx_parity(config_path, tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    from export import export_onnx
+    from models import OnnxModel
+
+    model = fused_model(config_path)
+    path = str(tmp_path / "model.onnx")
+    export_onnx(model, path, 128)
+    check_parity(model, OnnxModel(path), 128)
@@ -0,0 +1,35 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models import Darknet
+
+SHIPPED_CONFIGS = ["config/plate-tiny.cfg", "config/pchar-tiny.cfg", "config/pchar.cfg"]
+
+
+def randomized_model(config_path, img_size=128):
+    """A model in evaluation mode whose batch norms have non-trivial statistics"""
+    torch.manual_seed(0)
+    model = Darknet(config_path, img_size=img_size)
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.0)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.5, 0.5)
+    return model.eval()
+
+
+@pytest.mark.parametrize("config_path", SHIPPED_CONFIGS)
+def test_fuse_keeps_detections(config_path):
+    model = randomized_model(config_path)
+    imgs = torch.rand(2, 3, 128, 128)
+    with torch.no_grad():
+        reference = model(imgs)
+        model.fuse()
+        fused = model(imgs)
+
+    assert model.fused
+    assert not any(isinstance(module, torch.nn.BatchNorm2d) for module in model.modules())
+    # Compared before NMS: the random 84-class heads tie scores, so kept boxes may swap under rounding
+    torch.testing.assert_close(fused, reference, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,43 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+
+from models import Darknet
+from quantize import quantize
+
+
+def calibration_list(tmp_path, num_images=4, size=128):
+    from PIL import Image
+
+    (tmp_path / "images").mkdir()
+    (tmp_path / "labels").mkdir()
+    rng = np.random.RandomState(0)
+    img_paths = []
+    for i in range(num_images):
+        img_path = tmp_path / "images" / ("%d.jpg" % i)
+        Image.fromarray(rng.randint(0, 256, (size, size, 3), dtype=np.uint8)).save(str(img_path))
+        (tmp_path / "labels" / ("%d.txt" % i)).write_text("0 0.5 0.5 0.25 0.25\n")
+        img_paths.append(str(img_path))
+    list_path = tmp_path / "calib.txt"
+    list_path.write_text("".join(img_path + "\n" for img_path in img_paths))
+    return str(list_path)
+
+
+def test_int8_tracks_float(tmp_path):
+    if "fbgemm" not in torch.backends.quantized.supported_engines and "qnnpack" not in torch.backends.quantized.supported_engines:
+        pytest.skip("no quantized CPU engine")
+    torch.manual_seed(0)
+    model = Darknet("config/pchar-tiny.cfg", img_size=128).eval().fuse()
+    quantized = quantize(model, calibration_list(tmp_path), 128, batch_size=2, num_batches=2)
+
+    imgs = torch.rand(2, 3, 128, 128)
+    with torch.no_grad():
+        expected = model(imgs)
+        actual = quantized(imgs)
+    assert actual.shape == expected.shape
+    # Confidences are not flattened by a scale shared with pixel boxes
+    assert actual[..., 4].max() > 0
+    assert (actual[..., 4] - expected[..., 4]).abs().mean() < 0.05
+    assert (actual[..., 5:] - expected[..., 5:]).abs().mean() < 0.05
+    assert (actual[..., :4] - expected[..., :4]).abs().mean() < 0.05 * 128
@@ -0,0 +1,18 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+
+from utils.utils import DetectionEvaluator, coco_iou_thresholds
+
+
+@pytest.mark.parametrize("num_thresholds", [1, len(coco_iou_thresholds())])
+def test_evaluator_without_predictions(num_thresholds):
+    evaluator = DetectionEvaluator(num_thresholds=num_thresholds)
+    evaluator.update([], np.array([0, 1, 1]))
+    precision, recall, AP, f1, ap_class = evaluator.compute()
+
+    assert ap_class.tolist() == [0, 1]
+    for metric in (precision, recall, AP, f1):
+        assert not metric.any()
+        assert metric.shape == ((2,) if num_thresholds == 1 else (2, num_thresholds))
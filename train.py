@@ -5,6 +5,7 @@ from utils.logger import *
 from utils.utils import *
 from utils.datasets import *
 from utils.parse_config import *
+from utils.augmentations import BatchAugmentation
 from test import evaluate
 
 from terminaltables import AsciiTable
@@ -36,6 +37,10 @@ if __name__ == "__main__":
     parser.add_argument("--evaluation_interval", type=int, default=1, help="interval evaluations on validation set")
     parser.add_argument("--compute_map", default=False, help="if True computes mAP every tenth batch")
     parser.add_argument("--multiscale_training", default=True, help="allow for multi-scale training")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the multiscale input size schedule")
+    parser.add_argument("--rect", action="store_true", help="batch images by aspect ratio into rectangular inputs")
+    parser.add_argument("--cache_images", choices=["ram", "disk"], help="keep decoded images in RAM or on disk")
+    parser.add_argument("--batch_augment", action="store_true", help="augment whole batches on the device with the cfg values")
     opt = parser.parse_args()
     print(opt)
 
@@ -64,15 +69,33 @@ if __name__ == "__main__":
             model.load_darknet_weights(opt.pretrained_weights)
 
     # Get dataloader
-    dataset = ListDataset(train_path, augment=True, multiscale=opt.multiscale_training)
+    dataset = load_dataset(
+        train_path,
+        augment=not opt.batch_augment,
+        multiscale=opt.multiscale_training,
+        shuffle=True,
+        cache_images=opt.cache_images,
+        seed=opt.seed,
+    )
+    if isinstance(dataset, ListDataset):
+        # Aspect ratio buckets with --rect, multiscale sizes from a schedule shared by the workers
+        batch_sampler = make_batch_sampler(dataset, opt.batch_size, shuffle=True, rect=opt.rect, seed=opt.seed)
+        loader_args = dict(batch_sampler=batch_sampler)
+    else:
+        loader_args = dict(batch_size=opt.batch_size)
+    # Workers survive across epochs, batches are copied to the device ahead of use
     dataloader = torch.utils.data.DataLoader(
         dataset,
-        batch_size=opt.batch_size,
-        shuffle=True,
         num_workers=opt.n_cpu,
-        pin_memory=True,
+        pin_memory=device.type == "cuda",
+        persistent_workers=opt.n_cpu > 0,
         collate_fn=dataset.collate_fn,
+        **loader_args,
     )
+    prefetcher = DataPrefetcher(dataloader, device)
+    # Replaces the per-sample flip of the workers with color, geometric and mosaic augmentation of the batch,
+    # flipping only when the cfg sets flip=1
+    augmenter = BatchAugmentation.from_hyperparams(model.hyperparams) if opt.batch_augment else None
 
     optimizer = torch.optim.Adam(model.parameters())
 
@@ -95,12 +118,14 @@ if __name__ == "__main__":
 
     for epoch in range(opt.epochs):
         model.train()
+        # Samplers run in the main process, so this reaches persistent workers too
+        if hasattr(dataloader.batch_sampler, "set_epoch"):
+            dataloader.batch_sampler.set_epoch(epoch)
         start_time = time.time()
-        for batch_i, (_, imgs, targets) in enumerate(dataloader):
+        for batch_i, (_, imgs, targets) in enumerate(prefetcher):
             batches_done = len(dataloader) * epoch + batch_i
-
-            imgs = Variable(imgs.to(device))
-            targets = Variable(targets.to(device), requires_grad=False)
+            if augmenter is not None:
+                imgs, targets = augmenter(imgs, targets)
 
             loss, outputs = model(imgs, targets)
             loss.backward()
@@ -147,6 +172,9 @@ if __name__ == "__main__":
 
             model.seen += imgs.size(0)
 
+        print(prefetcher.summary())
+        logger.scalar_summary("data_starved", prefetcher.starved / max(prefetcher.batches, 1), epoch)
+
         if epoch % opt.evaluation_interval == 0:
             print("\n---- Evaluating Model ----")
             # Evaluate the model on the validation set
@@ -158,6 +186,9 @@ if __name__ == "__main__":
                 nms_thres=0.5,
                 img_size=opt.img_size,
                 batch_size=8,
+                cache_images=opt.cache_images,
+                rect=opt.rect,
+                num_workers=opt.n_cpu,
             )
             evaluation_metrics = [
                 ("val_precision", precision.mean()),
@@ -1,3 +1,5 @@
+import math
+
 import torch
 import torch.nn.functional as F
 import numpy as np
@@ -7,3 +9,224 @@ def horisontal_flip(images, targets):
     images = torch.flip(images, [-1])
     targets[:, 2] = 1 - targets[:, 2]
     return images, targets
+
+
+def rgb_to_hsv(images):
+    """(N, 3, H, W) RGB in [0, 1] to HSV, all channels in [0, 1]"""
+    r, g, b = images.unbind(1)
+    maxc, _ = images.max(1)
+    minc, _ = images.min(1)
+    delta = maxc - minc
+    safe_delta = torch.where(delta > 0, delta, torch.ones_like(delta))
+    rc, gc, bc = (maxc - r) / safe_delta, (maxc - g) / safe_delta, (maxc - b) / safe_delta
+    h = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2 + rc - bc, 4 + gc - rc))
+    h = torch.where(delta > 0, (h / 6) % 1, torch.zeros_like(h))
+    s = torch.where(maxc > 0, delta / torch.where(maxc > 0, maxc, torch.ones_like(maxc)), torch.zeros_like(maxc))
+    return torch.stack((h, s, maxc), 1)
+
+
+def hsv_to_rgb(images):
+    """(N, 3, H, W) HSV to RGB, all channels in [0, 1]"""
+    h, s, v = images.unbind(1)
+    h6 = (h % 1) * 6
+    i = h6.floor()
+    f = h6 - i
+    p = v * (1 - s)
+    q = v * (1 - s * f)
+    t = v * (1 - s * (1 - f))
+    i = i.long() % 6
+    # Channel values for each of the six hue sectors
+    r = torch.stack((v, q, p, p, t, v), 1).gather(1, i.unsqueeze(1))
+    g = torch.stack((t, v, v, q, p, p), 1).gather(1, i.unsqueeze(1))
+    b = torch.stack((p, p, t, v, v, q), 1).gather(1, i.unsqueeze(1))
+    return torch.cat((r, g, b), 1)
+
+
+def random_scale(n, amount, device):
+    """Darknet's rand_scale: factors in [1, amount], inverted with probability 0.5"""
+    scale = torch.empty(n, device=device).uniform_(1, max(amount, 1))
+    return torch.where(torch.rand(n, device=device) < 0.5, scale, 1 / scale)
+
+
+class BatchAugmentation(object):
+    """
+    Augments whole (N, 3, H, W) batches in [0, 1] with their (sample_i, label, x, y, w, h) targets,
+    after collate and on the batch's device, with one set of tensor ops per stage:
+    - mosaic: with probability 'mosaic' a sample becomes a 2 x 2 grid of half-size batch images
+    - color: 'saturation' and 'exposure' scale S and V by Darknet random scales, 'hue' shifts H
+      by up to that fraction of the hue circle, 'contrast' scales around the image mean
+    - geometry: rotation up to 'angle' degrees, scaling by up to 'scale', translation by up to
+      'translate' of the size, shear up to 'shear' degrees and perspective up to 'perspective',
+      as one homography per sample with boxes transformed through their corners
+    - flip: horizontal flip with probability 'flip'
+    """
+
+    def __init__(
+        self,
+        saturation=1.0,
+        exposure=1.0,
+        hue=0.0,
+        contrast=1.0,
+        angle=0.0,
+        scale=0.0,
+        translate=0.0,
+        shear=0.0,
+        perspective=0.0,
+        flip=0.0,
+        mosaic=0.0,
+        min_box_ratio=0.1,
+    ):
+        self.saturation = saturation
+        self.exposure = exposure
+        self.hue = hue
+        self.contrast = contrast
+        self.angle = angle
+        self.scale = scale
+        self.translate = translate
+        self.shear = shear
+        self.perspective = perspective
+        self.flip = flip
+        self.mosaic = mosaic
+        self.min_box_ratio = min_box_ratio
+
+    @classmethod
+    def from_hyperparams(cls, hyperparams, **kwargs):
+        """
+        Reads the [net] block of a model definition: saturation, exposure, hue and angle as in
+        Darknet, plus the optional contrast, scale, translate, shear, perspective and mosaic.
+        The random horizontal flip is off unless the block sets flip=1: mirrored characters hurt OCR.
+        """
+        defaults = cls().__dict__
+        params = {
+            name: float(hyperparams[name]) for name in defaults if name in hyperparams and name != "min_box_ratio"
+        }
+        params["flip"] = 0.5 if int(float(hyperparams.get("flip", 0))) else 0.0
+        params.update(kwargs)
+        return cls(**params)
+
+    def __call__(self, imgs, targets):
+        if self.mosaic > 0:
+            imgs, targets = self.apply_mosaic(imgs, targets)
+        imgs = self.apply_color(imgs)
+        if self.angle or self.scale or self.translate or self.shear or self.perspective:
+            imgs, targets = self.apply_geometry(imgs, targets)
+        if self.flip > 0:
+            imgs, targets = self.apply_flip(imgs, targets)
+        return imgs, targets
+
+    def apply_color(self, imgs):
+        n, device = imgs.size(0), imgs.device
+        if self.saturation != 1 or self.exposure != 1 or self.hue:
+            hsv = rgb_to_hsv(imgs)
+            hsv[:, 0] += torch.empty(n, device=device).uniform_(-self.hue, self.hue).view(n, 1, 1)
+            hsv[:, 1] *= random_scale(n, self.saturation, device).view(n, 1, 1)
+            hsv[:, 2] *= random_scale(n, self.exposure, device).view(n, 1, 1)
+            hsv[:, 1:] = hsv[:, 1:].clamp(0, 1)
+            imgs = hsv_to_rgb(hsv)
+        if self.contrast != 1:
+            mean = imgs.mean((1, 2, 3), keepdim=True)
+            imgs = (imgs - mean) * random_scale(n, self.contrast, device).view(n, 1, 1, 1) + mean
+        return imgs.clamp_(0, 1)
+
+    def homographies(self, n, height, width, device):
+        """Random (n, 3, 3) maps from input to output pixel coordinates centered on the image"""
+        angle = torch.empty(n, device=device).uniform_(-self.angle, self.angle) * math.pi / 180
+        scale = torch.empty(n, device=device).uniform_(1 - self.scale, 1 + self.scale)
+        shear = torch.empty(n, 2, device=device).uniform_(-self.shear, self.shear) * math.pi / 180
+        translate = torch.empty(n, 2, device=device).uniform_(-self.translate, self.translate)
+        translate = translate * torch.tensor([width, height], device=device, dtype=torch.float32)
+        perspective = torch.empty(n, 2, device=device).uniform_(-self.perspective, self.perspective)
+
+        eye = torch.eye(3, device=device).repeat(n, 1, 1)
+        rotation = eye.clone()
+        rotation[:, 0, 0] = rotation[:, 1, 1] = torch.cos(angle) * scale
+        rotation[:, 0, 1] = -torch.sin(angle) * scale
+        rotation[:, 1, 0] = torch.sin(angle) * scale
+        shearing = eye.clone()
+        shearing[:, 0, 1] = torch.tan(shear[:, 0])
+        shearing[:, 1, 0] = torch.tan(shear[:, 1])
+        projection = eye.clone()
+        projection[:, 2, :2] = perspective / max(height, width)
+        translation = eye.clone()
+        translation[:, :2, 2] = translate
+        return translation @ shearing @ rotation @ projection
+
+    def apply_geometry(self, imgs, targets):
+        n, _, height, width = imgs.shape
+        device = imgs.device
+        matrices = self.homographies(n, height, width, device)
+
+        # Sampling grid: output pixel -> input pixel through the inverse map, then to [-1, 1]
+        ys, xs = torch.meshgrid(
+            torch.arange(height, device=device, dtype=torch.float32) + 0.5 - height / 2,
+            torch.arange(width, device=device, dtype=torch.float32) + 0.5 - width / 2,
+        )
+        points = torch.stack((xs, ys, torch.ones_like(xs)), -1).view(1, -1, 3)
+        source = points @ torch.inverse(matrices).transpose(1, 2)
+        source = source[..., :2] / source[..., 2:]
+        grid = source / torch.tensor([width / 2, height / 2], device=device)
+        imgs = F.grid_sample(imgs, grid.view(n, height, width, 2), mode="bilinear", padding_mode="zeros", align_corners=False)
+
+        if targets is None or not len(targets):
+            return imgs, targets
+        # Box corners in centered pixels through the map of their sample
+        size = torch.tensor([width, height], device=device, dtype=targets.dtype)
+        xy, wh = targets[:, 2:4] * size - size / 2, targets[:, 4:6] * size
+        offsets = torch.tensor([[-1, -1], [1, -1], [-1, 1], [1, 1]], device=device, dtype=targets.dtype) / 2
+        corners = xy.unsqueeze(1) + offsets.unsqueeze(0) * wh.unsqueeze(1)
+        corners = torch.cat((corners, torch.ones_like(corners[..., :1])), -1)
+        box_matrices = matrices[targets[:, 0].long()]
+        corners = corners @ box_matrices.transpose(1, 2)
+        corners = corners[..., :2] / corners[..., 2:]
+        top_left = torch.max(corners.min(1)[0], -size / 2)
+        bottom_right = torch.min(corners.max(1)[0], size / 2)
+        new_wh = bottom_right - top_left
+
+        # Drop boxes that left the image or shrank too much
+        area = new_wh.prod(1)
+        keep = (new_wh > 2).all(1) & (area > self.min_box_ratio * wh.prod(1) * box_matrices[:, :2, :2].det().abs())
+        targets = targets.clone()
+        targets[:, 2:4] = ((top_left + bottom_right) / 2 + size / 2) / size
+        targets[:, 4:6] = new_wh / size
+        return imgs, targets[keep]
+
+    def apply_flip(self, imgs, targets):
+        flipped = torch.rand(imgs.size(0), device=imgs.device) < self.flip
+        imgs = torch.where(flipped.view(-1, 1, 1, 1), imgs.flip(-1), imgs)
+        if targets is not None and len(targets):
+            targets = targets.clone()
+            row_flipped = flipped[targets[:, 0].long()]
+            targets[row_flipped, 2] = 1 - targets[row_flipped, 2]
+        return imgs, targets
+
+    def apply_mosaic(self, imgs, targets):
+        n, _, height, width = imgs.shape
+        device = imgs.device
+        half_h, half_w = height // 2, width // 2
+        small = F.interpolate(imgs, size=(half_h, half_w), mode="bilinear", align_corners=False)
+        selected = torch.rand(n, device=device) < self.mosaic
+        # Source sample of each quadrant of each output, the first quadrant keeps the sample itself
+        sources = torch.stack([torch.arange(n, device=device)] + [torch.randint(n, (n,), device=device) for _ in range(3)])
+        quadrants = [small[quadrant_sources] for quadrant_sources in sources]
+        mosaics = torch.cat((torch.cat(quadrants[:2], 3), torch.cat(quadrants[2:], 3)), 2)
+        mosaics = F.pad(mosaics, (0, width - 2 * half_w, 0, height - 2 * half_h))
+        imgs = torch.where(selected.view(-1, 1, 1, 1), mosaics, imgs)
+
+        if targets is None:
+            return imgs, targets
+        kept = targets[~selected[targets[:, 0].long()]]
+        placed = [kept]
+        fractions = torch.tensor([half_w / width, half_h / height], device=device, dtype=targets.dtype)
+        for q, quadrant_sources in enumerate(sources):
+            # Every (target, output) pair where the target's sample fills quadrant q of a mosaic output
+            target_i, output_i = ((targets[:, :1].long() == quadrant_sources.unsqueeze(0)) & selected.unsqueeze(0)).nonzero(
+                as_tuple=True
+            )
+            rows = targets[target_i].clone()
+            rows[:, 0] = output_i.to(rows.dtype)
+            offset = torch.tensor([q % 2, q // 2], device=device, dtype=targets.dtype) * fractions
+            rows[:, 2:4] = rows[:, 2:4] * fractions + offset
+            rows[:, 4:6] = rows[:, 4:6] * fractions
+            placed.append(rows)
+        targets = torch.cat(placed, 0)
+        return imgs, targets[targets[:, 0].argsort()]
@@ -1,15 +1,23 @@
 import glob
 import random
 import os
+import io
 import sys
+import json
+import time
+import queue
+import threading
 import numpy as np
+import cv2
 from PIL import Image
 import torch
 import torch.nn.functional as F
 
 from utils.augmentations import horisontal_flip
-from torch.utils.data import Dataset
-# import torchvision.transforms as transforms
+from utils.utils import image_shape, letterbox_geometry
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler
+import torchvision.transforms as transforms
 
 
 def pad_to_square(img, pad_value):
@@ -30,12 +38,237 @@ def resize(image, size):
     return image
 
 
+def letterbox(img, size, out=None, pad_value=0):
+    """
+    Resizes an HxWx3 uint8 image with nearest interpolation so that it fits 'size', an int for a
+    square or (height, width), and pads the rest, written into 'out' when given. Returns the
+    letterboxed image and the geometry (scale_x, scale_y, pad_x, pad_y) that maps it back to the
+    image, see rescale_boxes.
+    """
+    h, w = img.shape[:2]
+    height, width = image_shape(size)
+    geometry = letterbox_geometry((h, w), (height, width))
+    scale_x, scale_y, pad_x, pad_y = geometry
+    new_w, new_h = int(round(scale_x * w)), int(round(scale_y * h))
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.uint8)
+    out[:pad_y] = pad_value
+    out[pad_y + new_h :] = pad_value
+    out[pad_y : pad_y + new_h, :pad_x] = pad_value
+    out[pad_y : pad_y + new_h, pad_x + new_w :] = pad_value
+    region = out[pad_y : pad_y + new_h, pad_x : pad_x + new_w]
+    if (new_h, new_w) == (h, w):
+        region[...] = img
+    elif pad_x == 0:
+        # Full rows are contiguous, so resize straight into the output
+        cv2.resize(img, (new_w, new_h), dst=region, interpolation=cv2.INTER_NEAREST)
+    else:
+        region[...] = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_NEAREST)
+    return out, geometry
+
+
+def letterbox_tensor(img, size):
+    """letterbox() of an HxWx3 uint8 array, as a 3 x height x width uint8 tensor with its geometry"""
+    img, geometry = letterbox(img, size)
+    return torch.from_numpy(np.ascontiguousarray(img.transpose(2, 0, 1))), geometry
+
+
+class Letterbox(object):
+    """
+    letterbox() into a buffer reused across calls, uploaded into a preallocated (1, 3, height, width)
+    float input on 'device'; 'size' is an int or (height, width). The returned input is overwritten
+    by the next call.
+    """
+
+    def __init__(self, size, device="cpu", pad_value=0):
+        self.size = size
+        self.pad_value = pad_value
+        height, width = image_shape(size)
+        self.canvas = np.full((height, width, 3), pad_value, dtype=np.uint8)
+        self.input = torch.empty((1, 3, height, width), dtype=torch.float32, device=device)
+
+    def __call__(self, img):
+        """Returns the model input of an HxWx3 uint8 RGB image and its geometry"""
+        canvas, geometry = letterbox(img, self.size, self.canvas, self.pad_value)
+        self.input[0].copy_(torch.from_numpy(canvas).permute(2, 0, 1))
+        self.input.div_(255)
+        return self.input, geometry
+
+
+def bucket_shape(h, w, size, multiple=32):
+    """
+    The smallest (height, width) input with sides multiples of 'multiple' and the longer side
+    'size' that an h x w image fits into when letterboxed
+    """
+    scale = size / max(h, w)
+    return tuple(min(int(np.ceil(side * scale / multiple)) * multiple, size) for side in (h, w))
+
+
+def scaled_shape(shape, size, multiple=32):
+    """Scales a (height, width) input shape so its longer side is 'size', sides staying multiples of 'multiple'"""
+    height, width = shape
+    scale = size / max(height, width)
+    return tuple(max(int(round(side * scale / multiple)), 1) * multiple for side in (height, width))
+
+
 def random_resize(images, min_size=288, max_size=448):
     new_size = random.sample(list(range(min_size, max_size + 1, 32)), 1)[0]
     images = F.interpolate(images, size=new_size, mode="nearest")
     return images
 
 
+def square_targets(boxes, h, w, size, normalized_labels=True):
+    """
+    Maps (label, x, y, w, h) label rows of an h x w image to targets (0, label, x, y, w, h)
+    relative to its letterbox into a size x size square. Returns None for images without label file.
+    """
+    geometry = letterbox_geometry((h, w), size)
+    return letterbox_targets(boxes, h, w, geometry, (size, size), normalized_labels)
+
+
+def letterbox_targets(boxes, h, w, geometry, shape, normalized_labels=True):
+    """
+    Maps (label, x, y, w, h) label rows of an h x w image to targets (0, label, x, y, w, h)
+    relative to its letterbox into a (height, width) 'shape' with 'geometry'
+    """
+    if boxes is None:
+        return None
+    boxes = torch.from_numpy(boxes)
+    scale_x, scale_y, pad_x, pad_y = geometry
+    height, width = shape
+    h_factor, w_factor = (h, w) if normalized_labels else (1, 1)
+    boxes[:, 1] = (boxes[:, 1] * w_factor * scale_x + pad_x) / width
+    boxes[:, 2] = (boxes[:, 2] * h_factor * scale_y + pad_y) / height
+    boxes[:, 3] *= w_factor * scale_x / width
+    boxes[:, 4] *= h_factor * scale_y / height
+
+    targets = torch.zeros((len(boxes), 6))
+    targets[:, 1:] = boxes
+    return targets
+
+
+def load_image_shapes(list_path, img_files):
+    """
+    (height, width) of every image of a list, read from the image headers once and saved as
+    '{list}.shapes.npy', which is rebuilt when the list file is newer
+    """
+    shapes_path = list_path + ".shapes.npy"
+    if os.path.exists(shapes_path) and os.path.getmtime(shapes_path) >= os.path.getmtime(list_path):
+        shapes = np.load(shapes_path)
+        if len(shapes) == len(img_files):
+            return shapes
+    shapes = np.zeros((len(img_files), 2), dtype=np.int64)
+    for i, img_path in enumerate(img_files):
+        w, h = Image.open(img_path.rstrip()).size
+        shapes[i] = h, w
+    try:
+        with open(shapes_path + ".tmp", "wb") as f:
+            np.save(f, shapes)
+        os.replace(shapes_path + ".tmp", shapes_path)
+    except OSError:
+        pass
+    return shapes
+
+
+class ImageCache(object):
+    """
+    Decoded images of a dataset, letterboxed to 'size', stored once as uint8 together with their
+    original height and width. Without 'path' the storage is shared memory,
+    so entries filled by DataLoader workers are seen by every process; with 'path' it is a
+    memory-mapped file that also survives across runs. 'stamp' (the list file mtime) is saved
+    as '{path}.stamp', a file written for another stamp is cleared. As for LabelIndex, replaced
+    images need a touch of the list file to be picked up.
+    """
+
+    def __init__(self, num_images, size, path=None, stamp=None):
+        self.size = size
+        if path is None:
+            self.images = torch.zeros((num_images, 3, size, size), dtype=torch.uint8).share_memory_()
+            # (filled, h, w) of each image
+            self.meta = torch.zeros((num_images, 3), dtype=torch.int32).share_memory_()
+        else:
+            stamp_path = path + ".stamp"
+            fresh = os.path.exists(stamp_path)
+            if fresh:
+                with open(stamp_path) as f:
+                    fresh = f.read() == repr(stamp)
+            shapes = {path + ".u8": (num_images, 3, size, size), path + ".meta": (num_images, 3)}
+            dtypes = {path + ".u8": np.uint8, path + ".meta": np.int32}
+            arrays = []
+            for file_path, shape in shapes.items():
+                nbytes = int(np.prod(shape)) * np.dtype(dtypes[file_path]).itemsize
+                # A file of another size belongs to another list or image size
+                reuse = fresh and os.path.exists(file_path) and os.path.getsize(file_path) == nbytes
+                mode = "r+" if reuse else "w+"
+                arrays.append(torch.from_numpy(np.memmap(file_path, dtype=dtypes[file_path], mode=mode, shape=shape)))
+            self.images, self.meta = arrays
+            if not fresh:
+                with open(stamp_path, "w") as f:
+                    f.write(repr(stamp))
+
+    def get(self, index):
+        """Returns the uint8 image and its original (h, w), or None if it is not cached yet"""
+        filled, h, w = self.meta[index].tolist()
+        if not filled:
+            return None
+        return self.images[index], h, w
+
+    def put(self, index, img, h, w):
+        """Stores a letterboxed 3 x size x size uint8 image"""
+        self.images[index] = img
+        self.meta[index] = torch.tensor([1, h, w], dtype=torch.int32)
+
+
+class LabelIndex(object):
+    """
+    All label files of a list parsed once into one contiguous (N, 5) array, with the (start, count)
+    of every image in a (num_images, 2) offsets array; count is -1 when the label file is missing.
+    Both are saved as '{list}.labels.npy' and '{list}.label_offsets.npy' and rebuilt when the list
+    file is newer than them. Edited label files need a touch of the list file to be picked up.
+    """
+
+    def __init__(self, list_path, label_files):
+        labels_path = list_path + ".labels.npy"
+        offsets_path = list_path + ".label_offsets.npy"
+        list_mtime = os.path.getmtime(list_path)
+        if all(os.path.exists(path) and os.path.getmtime(path) >= list_mtime for path in (labels_path, offsets_path)):
+            self.labels = np.load(labels_path, mmap_mode="r")
+            self.offsets = np.load(offsets_path, mmap_mode="r")
+            if len(self.offsets) == len(label_files):
+                return
+        self.labels, self.offsets = self.build(label_files)
+        try:
+            for path, array in ((labels_path, self.labels), (offsets_path, self.offsets)):
+                with open(path + ".tmp", "wb") as f:
+                    np.save(f, array)
+                os.replace(path + ".tmp", path)
+        except OSError:
+            # Read-only dataset location, keep the index in memory only
+            pass
+
+    @staticmethod
+    def build(label_files):
+        boxes, offsets, start = [], np.zeros((len(label_files), 2), dtype=np.int64), 0
+        for i, label_path in enumerate(label_files):
+            label_path = label_path.rstrip()
+            if not os.path.exists(label_path):
+                offsets[i] = start, -1
+                continue
+            image_boxes = np.loadtxt(label_path).reshape(-1, 5)
+            boxes.append(image_boxes)
+            offsets[i] = start, len(image_boxes)
+            start += len(image_boxes)
+        labels = np.concatenate(boxes, 0) if boxes else np.zeros((0, 5))
+        return labels, offsets
+
+    def __getitem__(self, index):
+        """Returns a copy of the (label, x, y, w, h) rows of image 'index', or None without label file"""
+        start, count = self.offsets[index]
+        if count < 0:
+            return None
+        return np.array(self.labels[start : start + count])
+
+
 class ImageFolder(Dataset):
     def __init__(self, folder_path, img_size=416):
         self.files = sorted(glob.glob("%s/*.*" % folder_path))
@@ -43,21 +276,27 @@ class ImageFolder(Dataset):
 
     def __getitem__(self, index):
         img_path = self.files[index % len(self.files)]
-        # Extract image as PyTorch tensor
-        img = transforms.ToTensor()(Image.open(img_path))
-        # Pad to square resolution
-        img, _ = pad_to_square(img, 0)
-        # Resize
-        img = resize(img, self.img_size)
+        # Letterbox in uint8, scale to [0, 1] once at input size
+        img, _ = letterbox_tensor(np.asarray(Image.open(img_path).convert("RGB")), self.img_size)
 
-        return img_path, img
+        return img_path, img.float().div_(255)
 
     def __len__(self):
         return len(self.files)
 
 
 class ListDataset(Dataset):
-    def __init__(self, list_path, img_size=416, augment=True, multiscale=True, normalized_labels=True):
+    def __init__(
+        self,
+        list_path,
+        img_size=416,
+        augment=True,
+        multiscale=True,
+        normalized_labels=True,
+        cache_images=None,
+        cache_dir=None,
+    ):
+        """'cache_images' is None, "ram" or "disk" (an ImageCache file in 'cache_dir' or next to the list)"""
         with open(list_path, "r") as file:
             self.img_files = file.readlines()
 
@@ -65,6 +304,8 @@ class ListDataset(Dataset):
             path.replace("images", "labels").replace(".png", ".txt").replace(".jpg", ".txt")
             for path in self.img_files
         ]
+        self.label_index = LabelIndex(list_path, self.label_files)
+        self.list_path = list_path
         self.img_size = img_size
         self.max_objects = 100
         self.augment = augment
@@ -73,56 +314,85 @@ class ListDataset(Dataset):
         self.min_size = self.img_size - 3 * 32
         self.max_size = self.img_size + 3 * 32
         self.batch_count = 0
+        # Set when the batch sampler attaches an input shape to every index, see make_batch_sampler
+        self.sized_by_sampler = False
+
+        # Images are letterboxed at the largest input size, collate_fn resizes down for smaller scales
+        self.letterbox_size = self.max_size if multiscale else self.img_size
+
+        self.cache = None
+        if cache_images:
+            cache_path = None
+            if cache_images == "disk":
+                cache_dir = cache_dir or os.path.dirname(os.path.abspath(list_path))
+                cache_name = "%s.%d.images" % (os.path.basename(list_path), self.letterbox_size)
+                cache_path = os.path.join(cache_dir, cache_name)
+            self.cache = ImageCache(len(self.img_files), self.letterbox_size, cache_path, os.path.getmtime(list_path))
+
+    def decode_image(self, index):
+        """Decodes image 'index' to HxWx3 uint8, converting images with less than three channels"""
+        return np.asarray(Image.open(self.img_files[index].rstrip()).convert('RGB'))
+
+    def load_image(self, index):
+        """Returns the letterboxed image as a uint8 tensor, with its original height and width"""
+        if self.cache is not None:
+            cached = self.cache.get(index)
+            if cached is not None:
+                return cached
+
+        img = self.decode_image(index)
+        h, w = img.shape[:2]
+        img, _ = letterbox_tensor(img, self.letterbox_size)
+        if self.cache is not None:
+            self.cache.put(index, img, h, w)
+        return img, h, w
+
+    def image_shapes(self):
+        """(height, width) of every image, see load_image_shapes"""
+        return load_image_shapes(self.list_path, self.img_files)
+
+    def fit_letterbox(self, img, h, w, shape):
+        """
+        Letterboxes an image returned by load_image into a (height, width) 'shape' by cropping its
+        padding, returns it with its geometry relative to the original h x w image. Only used for
+        cached images, which are stored at 'letterbox_size'; others are letterboxed to 'shape' directly.
+        """
+        scale_x, scale_y, pad_x, pad_y = letterbox_geometry((h, w), self.letterbox_size)
+        new_w, new_h = int(round(scale_x * w)), int(round(scale_y * h))
+        region = np.ascontiguousarray(img[:, pad_y : pad_y + new_h, pad_x : pad_x + new_w].permute(1, 2, 0).numpy())
+        img, (fit_scale_x, fit_scale_y, fit_pad_x, fit_pad_y) = letterbox_tensor(region, shape)
+        return img, (scale_x * fit_scale_x, scale_y * fit_scale_y, fit_pad_x, fit_pad_y)
 
     def __getitem__(self, index):
+        """'index' may also be (index, (height, width)) to letterbox to a rectangular shape"""
 
         # ---------
         #  Image
         # ---------
 
-        img_path = self.img_files[index % len(self.img_files)].rstrip()
-
-        # Extract image as PyTorch tensor
-        img = transforms.ToTensor()(Image.open(img_path).convert('RGB'))
-
-        # Handle images with less than three channels
-        if len(img.shape) != 3:
-            img = img.unsqueeze(0)
-            img = img.expand((3, img.shape[1:]))
-
-        _, h, w = img.shape
-        h_factor, w_factor = (h, w) if self.normalized_labels else (1, 1)
-        # Pad to square resolution
-        img, pad = pad_to_square(img, 0)
-        _, padded_h, padded_w = img.shape
+        shape = None
+        if isinstance(index, tuple):
+            index, shape = index
+        index = index % len(self.img_files)
+        img_path = self.img_files[index].rstrip()
+        if shape is not None and self.cache is None:
+            # Resampled once, straight to the shape from the sampler
+            img = self.decode_image(index)
+            h, w = img.shape[:2]
+            img, geometry = letterbox_tensor(img, shape)
+        else:
+            img, h, w = self.load_image(index)
+            if shape is not None:
+                img, geometry = self.fit_letterbox(img, h, w, shape)
 
         # ---------
         #  Label
         # ---------
 
-        label_path = self.label_files[index % len(self.img_files)].rstrip()
-
-        targets = None
-        if os.path.exists(label_path):
-            boxes = torch.from_numpy(np.loadtxt(label_path).reshape(-1, 5))
-            # Extract coordinates for unpadded + unscaled image
-            x1 = w_factor * (boxes[:, 1] - boxes[:, 3] / 2)
-            y1 = h_factor * (boxes[:, 2] - boxes[:, 4] / 2)
-            x2 = w_factor * (boxes[:, 1] + boxes[:, 3] / 2)
-            y2 = h_factor * (boxes[:, 2] + boxes[:, 4] / 2)
-            # Adjust for added padding
-            x1 += pad[0]
-            y1 += pad[2]
-            x2 += pad[1]
-            y2 += pad[3]
-            # Returns (x, y, w, h)
-            boxes[:, 1] = ((x1 + x2) / 2) / padded_w
-            boxes[:, 2] = ((y1 + y2) / 2) / padded_h
-            boxes[:, 3] *= w_factor / padded_w
-            boxes[:, 4] *= h_factor / padded_h
-
-            targets = torch.zeros((len(boxes), 6))
-            targets[:, 1:] = boxes
+        if shape is None:
+            targets = square_targets(self.label_index[index], h, w, self.letterbox_size, self.normalized_labels)
+        else:
+            targets = letterbox_targets(self.label_index[index], h, w, geometry, shape, self.normalized_labels)
 
         # Apply augmentations
         if self.augment:
@@ -139,13 +409,375 @@ class ListDataset(Dataset):
         for i, boxes in enumerate(targets):
             boxes[:, 0] = i
         targets = torch.cat(targets, 0)
-        # Selects new image size every tenth batch
-        if self.multiscale and self.batch_count % 10 == 0:
-            self.img_size = random.choice(range(self.min_size, self.max_size + 1, 32))
-        # Resize images to input shape
-        imgs = torch.stack([resize(img, self.img_size) for img in imgs])
+        # Scale the uint8 images to [0, 1] as one batch
+        imgs = torch.stack(imgs).float().div_(255)
+        if not self.sized_by_sampler:
+            if self.multiscale:
+                self.img_size = self.multiscale_size()
+            # Resize to input shape in one op, rectangular batches keep their aspect ratio
+            # with the longer side at the input size
+            height, width = imgs.shape[-2:]
+            shape = (self.img_size, self.img_size) if height == width else scaled_shape((height, width), self.img_size)
+            if tuple(imgs.shape[-2:]) != shape:
+                imgs = F.interpolate(imgs, size=shape, mode="nearest")
         self.batch_count += 1
         return paths, imgs, targets
 
+    def multiscale_size(self):
+        """
+        Input size of a batch collated without a sized batch sampler: a new random size every tenth
+        batch, chosen per worker (make_batch_sampler shares a MultiScaleSchedule instead)
+        """
+        if self.batch_count % 10 == 0:
+            return random.choice(range(self.min_size, self.max_size + 1, 32))
+        return self.img_size
+
     def __len__(self):
         return len(self.img_files)
+
+
+class AspectRatioBatchSampler(Sampler):
+    """
+    Batches the images of a ListDataset by bucket shape, the smallest rectangular input with the
+    longer side at the dataset's letterbox size that fits them (see bucket_shape), so batches are
+    not padded to squares. Yields lists of (index, shape) that make ListDataset letterbox each
+    image to its bucket; collate_fn then applies the multiscale input size to the longer side.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.buckets = {}
+        for index, (h, w) in enumerate(dataset.image_shapes()):
+            self.buckets.setdefault(bucket_shape(h, w, dataset.letterbox_size), []).append(index)
+
+    def __iter__(self):
+        batches = []
+        for shape, indices in sorted(self.buckets.items()):
+            indices = list(indices)
+            if self.shuffle:
+                random.shuffle(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start : start + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append([(index, shape) for index in batch])
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for indices in self.buckets.values())
+        return sum(-(-len(indices) // self.batch_size) for indices in self.buckets.values())
+
+
+class MultiScaleSchedule(object):
+    """
+    Multiscale input sizes that only depend on the seed, the epoch and the batch number, with a
+    new size every 'interval' batches, so the schedule is reproducible and independent of which
+    worker loads a batch
+    """
+
+    def __init__(self, min_size, max_size, interval=10, seed=0, multiple=32):
+        self.sizes = list(range(min_size, max_size + 1, multiple))
+        self.interval = interval
+        self.seed = seed
+
+    def size(self, epoch, batch_i):
+        return random.Random("%d-%d-%d" % (self.seed, epoch, batch_i // self.interval)).choice(self.sizes)
+
+
+class MultiScaleBatchSampler(Sampler):
+    """
+    Attaches the input shape of a MultiScaleSchedule to every index of the batches of
+    'batch_sampler', so workers letterbox images straight to it: (size, size) for plain indices,
+    the (index, shape) of AspectRatioBatchSampler scaled to a longer side of size. Call
+    set_epoch before every epoch, as for DistributedSampler.
+    """
+
+    def __init__(self, batch_sampler, schedule):
+        self.batch_sampler = batch_sampler
+        self.schedule = schedule
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        for batch_i, batch in enumerate(self.batch_sampler):
+            size = self.schedule.size(self.epoch, batch_i)
+            yield [
+                (item[0], scaled_shape(item[1], size)) if isinstance(item, tuple) else (item, (size, size))
+                for item in batch
+            ]
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+def make_batch_sampler(dataset, batch_size, shuffle=False, rect=False, seed=0):
+    """
+    Batch sampler of a ListDataset: aspect ratio buckets with 'rect', and with dataset.multiscale
+    a MultiScaleSchedule whose input sizes are applied while loading in the workers
+    """
+    if rect:
+        batch_sampler = AspectRatioBatchSampler(dataset, batch_size, shuffle=shuffle)
+    else:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+    if dataset.multiscale:
+        schedule = MultiScaleSchedule(dataset.min_size, dataset.max_size, seed=seed)
+        batch_sampler = MultiScaleBatchSampler(batch_sampler, schedule)
+        # Shapes come with the indices, collate_fn must not resize
+        dataset.sized_by_sampler = True
+    return batch_sampler
+
+
+SHARD_INDEX = "shards.json"
+# Columns of a shard's record index
+SHARD_OFFSET, SHARD_NBYTES, SHARD_LABEL_START, SHARD_LABEL_COUNT, SHARD_H, SHARD_W = range(6)
+
+
+class ShardDataset(IterableDataset):
+    """
+    Reads a directory written by pack_shards.py. Every shard is a data file of consecutive image
+    records ('{name}.bin'), a (count, 6) record index ('{name}.index.npy'), the label rows of its
+    images ('{name}.labels.npy') and their paths ('{name}.paths'). Images are encoded files, or
+    uint8 images already letterboxed to a square when the pack was made with an img_size.
+    Shards are read sequentially and split across DataLoader workers; with 'shuffle' the shard
+    order changes every epoch and samples pass through a shuffle buffer. Yields the same samples
+    as ListDataset and shares its collate_fn. Packed images must all have one size.
+    """
+
+    def __init__(
+        self,
+        shard_dir,
+        img_size=416,
+        augment=True,
+        multiscale=True,
+        normalized_labels=True,
+        shuffle=False,
+        buffer_size=1024,
+        seed=0,
+    ):
+        with open(os.path.join(shard_dir, SHARD_INDEX), "r") as f:
+            index = json.load(f)
+        self.shard_dir = shard_dir
+        self.shards = index["shards"]
+        self.packed_size = index["img_size"]
+        self.img_size = img_size
+        self.augment = augment
+        self.multiscale = multiscale
+        self.normalized_labels = normalized_labels
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.min_size = self.img_size - 3 * 32
+        self.max_size = self.img_size + 3 * 32
+        self.letterbox_size = self.max_size if multiscale else self.img_size
+        self.batch_count = 0
+        self.epoch = 0
+        # Shards are read in storage order, collate_fn picks the multiscale sizes from the schedule
+        self.sized_by_sampler = False
+        self.schedule = MultiScaleSchedule(self.min_size, self.max_size, seed=seed)
+        self.epoch_seed, self.worker_id, self.num_workers = 0, 0, 1
+
+    def __len__(self):
+        return sum(shard["count"] for shard in self.shards)
+
+    def read_shard(self, name):
+        """Yields the (img_path, img, targets) samples of one shard in storage order"""
+        path = os.path.join(self.shard_dir, name)
+        records = np.load(path + ".index.npy")
+        labels = np.load(path + ".labels.npy", mmap_mode="r")
+        with open(path + ".paths", "r") as f:
+            img_paths = f.read().splitlines()
+        with open(path + ".bin", "rb") as f:
+            for img_path, record in zip(img_paths, records):
+                data = f.read(int(record[SHARD_NBYTES]))
+                h, w = int(record[SHARD_H]), int(record[SHARD_W])
+                size = self.packed_size or self.letterbox_size
+                if self.packed_size:
+                    img = torch.frombuffer(bytearray(data), dtype=torch.uint8)
+                    img = img.view(3, size, size)
+                else:
+                    img = np.asarray(Image.open(io.BytesIO(data)).convert("RGB"))
+                    img, _ = letterbox_tensor(img, size)
+
+                boxes = None
+                if record[SHARD_LABEL_COUNT] >= 0:
+                    start = int(record[SHARD_LABEL_START])
+                    boxes = np.array(labels[start : start + int(record[SHARD_LABEL_COUNT])])
+                targets = square_targets(boxes, h, w, size, self.normalized_labels)
+
+                # Apply augmentations
+                if self.augment:
+                    if np.random.random() < 0.5:
+                        img, targets = horisontal_flip(img, targets)
+
+                yield img_path, img, targets
+
+    def multiscale_size(self):
+        """
+        Input size of the next batch of this worker from the schedule. The DataLoader takes batches
+        from the workers in turn, so its n-th batch here is batch n * num_workers + worker_id overall.
+        """
+        return self.schedule.size(self.epoch_seed, self.batch_count * self.num_workers + self.worker_id)
+
+    def __iter__(self):
+        shards = [shard["name"] for shard in self.shards]
+        worker = get_worker_info()
+        # The DataLoader base seed is shared by the workers of an epoch, so all workers agree on
+        # the shard order, the split below stays a partition and the multiscale schedule is
+        # the same. It changes every epoch unless the workers are persistent, where the epoch
+        # counter of their dataset copy moves instead
+        self.epoch += 1
+        base_seed = worker.seed - worker.id if worker is not None else torch.initial_seed()
+        self.epoch_seed = base_seed + self.epoch
+        self.batch_count = 0
+        if worker is not None:
+            self.worker_id, self.num_workers = worker.id, worker.num_workers
+        if self.shuffle:
+            random.Random(self.epoch_seed).shuffle(shards)
+        if worker is not None:
+            shards = shards[worker.id :: worker.num_workers]
+
+        buffer = []
+        for name in shards:
+            for sample in self.read_shard(name):
+                if not self.shuffle:
+                    yield sample
+                elif len(buffer) < self.buffer_size:
+                    buffer.append(sample)
+                else:
+                    i = random.randrange(len(buffer))
+                    buffer[i], sample = sample, buffer[i]
+                    yield sample
+        random.shuffle(buffer)
+        yield from buffer
+
+    collate_fn = ListDataset.collate_fn
+
+
+class DataPrefetcher(object):
+    """
+    Iterates over a DataLoader of (paths, imgs, targets) batches with the next batch already on
+    its way to 'device'. On CUDA pinned batches are copied on a side stream while the current batch
+    computes; elsewhere a background thread stages up to 'depth' batches. Targets stay on the host
+    without 'move_targets'. Counts the batches for which the consumer had to wait for data.
+    """
+
+    def __init__(self, loader, device, depth=2, move_targets=True, starved_after=1e-3):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.move_targets = move_targets
+        self.starved_after = starved_after
+        self.batches = 0
+        self.starved = 0
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        paths, imgs, targets = batch
+        imgs = imgs.to(self.device, non_blocking=True)
+        if self.move_targets:
+            targets = targets.to(self.device, non_blocking=True)
+        return paths, imgs, targets
+
+    def _count(self, wait):
+        self.batches += 1
+        self.wait_time += wait
+        if wait > self.starved_after:
+            self.starved += 1
+
+    def __iter__(self):
+        self.batches, self.starved, self.wait_time = 0, 0, 0.0
+        if self.device.type == "cuda":
+            return self._iter_stream()
+        return self._iter_thread()
+
+    def _iter_stream(self):
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.loader)
+
+        def preload():
+            start = time.time()
+            batch = next(batches, None)
+            wait = time.time() - start
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return self._to_device(batch), wait
+
+        staged = preload()
+        while staged is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            (paths, imgs, targets), wait = staged
+            # The tensors were allocated on the side stream but are used on the current one
+            imgs.record_stream(current_stream)
+            if self.move_targets:
+                targets.record_stream(current_stream)
+            staged = preload()
+            self._count(wait)
+            yield paths, imgs, targets
+
+    def _iter_thread(self):
+        staged = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # Gives up once the consumer is gone
+            while not stop.is_set():
+                try:
+                    staged.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def stage():
+            try:
+                for batch in self.loader:
+                    if not put(self._to_device(batch)):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=stage, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                batch = staged.get()
+                wait = time.time() - start
+                if batch is done:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                self._count(wait)
+                yield batch
+        finally:
+            stop.set()
+
+    def summary(self):
+        return "Data starved %d/%d batches (%.1fs waiting)" % (self.starved, self.batches, self.wait_time)
+
+
+def load_dataset(path, img_size=416, augment=True, multiscale=True, shuffle=False, cache_images=None, seed=0):
+    """
+    A ShardDataset for a directory written by pack_shards.py, a ListDataset for a list file.
+    'shuffle' and 'seed' (of the multiscale schedule) apply to shards only, ListDataset is
+    shuffled by its DataLoader and gets its schedule from make_batch_sampler.
+    """
+    if os.path.isdir(path) and os.path.exists(os.path.join(path, SHARD_INDEX)):
+        return ShardDataset(
+            path, img_size=img_size, augment=augment, multiscale=multiscale, shuffle=shuffle, seed=seed
+        )
+    return ListDataset(path, img_size=img_size, augment=augment, multiscale=multiscale, cache_images=cache_images)
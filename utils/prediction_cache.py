@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+
+CANDIDATE_COLUMNS = 7  # x1, y1, x2, y2, conf, cls_conf, cls_pred
+TARGET_COLUMNS = 5  # label, x1, y1, x2, y2
+
+
+def model_key(model_def, weights_path, img_size, floor):
+    """Identifies the cached predictions of one model: its definition, weights, input size and confidence floor"""
+    digest = hashlib.sha1()
+    for path in (model_def, weights_path):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    digest.update(("%d:%g" % (img_size, floor)).encode())
+    return digest.hexdigest()[:16]
+
+
+class PredictionCacheWriter(object):
+    """
+    Appends pre-NMS candidates (x1, y1, x2, y2, conf, cls_conf, cls_pred) and pixel targets of each
+    image to flat float32 files in 'cache_dir/key'. close() writes the index that maps image paths to rows.
+    """
+
+    def __init__(self, cache_dir, key, floor, img_size):
+        self.path = os.path.join(cache_dir, key)
+        os.makedirs(self.path, exist_ok=True)
+        self.floor = floor
+        self.img_size = img_size
+        self.image_paths = []
+        self.candidate_counts = []
+        self.target_counts = []
+        self.candidates = open(os.path.join(self.path, "candidates.f32"), "wb")
+        self.targets = open(os.path.join(self.path, "targets.f32"), "wb")
+
+    def add(self, image_paths, candidates, targets):
+        """Adds a batch: per image candidates and the (sample_i, label, x1, y1, x2, y2) targets"""
+        targets = targets.cpu()
+        target_samples = targets[:, 0].long()
+        for sample_i, (image_path, rows) in enumerate(zip(image_paths, candidates)):
+            rows = rows.detach().float().cpu().numpy()
+            sample_targets = targets[target_samples == sample_i, 1:].numpy().astype(np.float32)
+            self.candidates.write(rows.tobytes())
+            self.targets.write(sample_targets.tobytes())
+            self.image_paths.append(image_path)
+            self.candidate_counts.append(len(rows))
+            self.target_counts.append(len(sample_targets))
+
+    def close(self):
+        self.candidates.close()
+        self.targets.close()
+        with open(os.path.join(self.path, "index.json"), "w") as f:
+            json.dump(
+                {
+                    "floor": self.floor,
+                    "img_size": self.img_size,
+                    "image_paths": self.image_paths,
+                    "candidate_counts": self.candidate_counts,
+                    "target_counts": self.target_counts,
+                },
+                f,
+            )
+
+
+class PredictionCache(object):
+    """Memory-mapped read access to a cache written by PredictionCacheWriter"""
+
+    def __init__(self, cache_dir, key):
+        self.path = os.path.join(cache_dir, key)
+        with open(os.path.join(self.path, "index.json")) as f:
+            index = json.load(f)
+        self.floor = index["floor"]
+        self.img_size = index["img_size"]
+        self.image_paths = index["image_paths"]
+        self.image_index = {image_path: i for i, image_path in enumerate(self.image_paths)}
+        self.candidate_offsets = np.cumsum([0] + index["candidate_counts"])
+        self.target_offsets = np.cumsum([0] + index["target_counts"])
+        self.candidates = self._map("candidates.f32", CANDIDATE_COLUMNS)
+        self.targets = self._map("targets.f32", TARGET_COLUMNS)
+
+    def _map(self, name, columns):
+        path = os.path.join(self.path, name)
+        if not os.path.getsize(path):
+            return np.zeros((0, columns), dtype=np.float32)
+        return np.memmap(path, dtype=np.float32, mode="r").reshape(-1, columns)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def batch(self, indices):
+        """
+        Returns the candidates of images 'indices' as a list of tensors and their targets as
+        (sample_i, label, x1, y1, x2, y2), with sample_i the position in 'indices'
+        """
+        candidates, targets = [], []
+        for sample_i, i in enumerate(indices):
+            rows = self.candidates[self.candidate_offsets[i] : self.candidate_offsets[i + 1]]
+            candidates.append(torch.from_numpy(np.array(rows)))
+            image_targets = self.targets[self.target_offsets[i] : self.target_offsets[i + 1]]
+            targets.append(np.concatenate((np.full((len(image_targets), 1), sample_i, np.float32), image_targets), 1))
+        return candidates, torch.from_numpy(np.concatenate(targets, 0))
+
+    def lookup(self, image_paths):
+        """Same as batch(), by image path"""
+        return self.batch([self.image_index[image_path] for image_path in image_paths])
@@ -6,6 +6,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torchvision.ops import batched_nms
 import numpy as np
 # import matplotlib.pyplot as plt
 # import matplotlib.patches as patches
@@ -33,8 +34,44 @@ def weights_init_normal(m):
         torch.nn.init.constant_(m.bias.data, 0.0)
 
 
-def rescale_boxes(boxes, current_dim, original_shape):
-    """ Rescales bounding boxes to the original shape """
+def image_shape(size):
+    """ (height, width) of an input size given as an int or as (height, width) """
+    return (size, size) if isinstance(size, int) else tuple(size)
+
+
+def parse_image_shape(value):
+    """ Parses an input size given as "416" or as "HxW" such as "128x416" """
+    if "x" not in value:
+        return int(value)
+    height, width = value.lower().split("x")
+    return int(height), int(width)
+
+
+def letterbox_geometry(original_shape, size):
+    """
+    The (scale_x, scale_y, pad_x, pad_y) of letterboxing an image of 'original_shape' into 'size'
+    (an int or (height, width)): uniform scale to fit, minimal centered padding
+    """
+    orig_h, orig_w = original_shape
+    height, width = image_shape(size)
+    scale = min(height / orig_h, width / orig_w)
+    new_w, new_h = max(int(round(orig_w * scale)), 1), max(int(round(orig_h * scale)), 1)
+    return new_w / orig_w, new_h / orig_h, (width - new_w) // 2, (height - new_h) // 2
+
+
+def rescale_boxes(boxes, current_dim, original_shape, geometry=None):
+    """
+    Rescales bounding boxes to the original shape. 'geometry' is the (scale_x, scale_y, pad_x, pad_y)
+    returned by letterbox; without it a square 'current_dim' is taken to be the image padded to
+    square then resized (pad_to_square and resize), and a rectangular (height, width) one a letterbox.
+    """
+    if geometry is None and not isinstance(current_dim, int):
+        geometry = letterbox_geometry(original_shape, current_dim)
+    if geometry is not None:
+        scale_x, scale_y, pad_x, pad_y = geometry
+        boxes[:, [0, 2]] = (boxes[:, [0, 2]] - pad_x) / scale_x
+        boxes[:, [1, 3]] = (boxes[:, [1, 3]] - pad_y) / scale_y
+        return boxes
     orig_h, orig_w = original_shape
     # The amount of padding that was added
     pad_x = max(orig_h - orig_w, 0) * (current_dim / max(original_shape))
@@ -59,6 +96,38 @@ def xywh2xyxy(x):
     return y
 
 
+def split_candidates(rows, image_i, num_images, top_k=None):
+    """
+    Splits candidate rows into one tensor per image, given the image index of every row,
+    keeping the 'top_k' most confident rows of each image
+    """
+    order = image_i.sort(stable=True)[1]
+    counts = torch.bincount(image_i, minlength=num_images).tolist()
+    candidates = list(torch.split(rows[order], counts))
+    if top_k is not None:
+        for i, image_rows in enumerate(candidates):
+            if len(image_rows) > top_k:
+                candidates[i] = image_rows[image_rows[:, 4].topk(top_k)[1]]
+    return candidates
+
+
+def select_candidates(prediction, conf_thres, top_k=None):
+    """
+    Returns, per image, the decoded rows with object confidence >= 'conf_thres'
+    converted to (x1, y1, x2, y2, ...), keeping at most 'top_k' rows per image
+    """
+    image_i, anchor_i = (prediction[..., 4] >= conf_thres).nonzero(as_tuple=True)
+    rows = prediction[image_i, anchor_i]
+    rows[:, :4] = xywh2xyxy(rows[:, :4])
+    return split_candidates(rows, image_i, len(prediction), top_k)
+
+
+def compact_predictions(prediction):
+    """ Reduces (x, y, w, h, conf, cls...) rows to (x, y, w, h, conf, cls_conf, cls_pred) """
+    class_confs, class_preds = prediction[..., 5:].max(-1, keepdim=True)
+    return torch.cat((prediction[..., :5], class_confs, class_preds.to(prediction.dtype)), -1)
+
+
 def ap_per_class(tp, conf, pred_cls, target_cls):
     """ Compute the average precision, given the recall and precision curves.
     Source: https://github.com/rafaelpadilla/Object-Detection-Metrics.
@@ -71,30 +140,40 @@ def ap_per_class(tp, conf, pred_cls, target_cls):
         The average precision as computed in py-faster-rcnn.
     """
 
+    unique_classes, n_gts = np.unique(target_cls, return_counts=True)
+    return class_metrics(tp, conf, pred_cls, unique_classes, n_gts)
+
+
+def class_metrics(tp, conf, pred_cls, classes, n_gts):
+    """
+    Precision, recall, AP and F1 of each class in 'classes', which has n_gts ground truth objects.
+    'tp' may be a (N, T) matrix for T IoU thresholds, in which case every metric gets a T column.
+    """
+
     # Sort by objectness
-    i = np.argsort(-conf)
+    i = np.argsort(-conf, kind="stable")
     tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
-
-    # Find unique classes
-    unique_classes = np.unique(target_cls)
+    single_threshold = tp.ndim == 1
+    # Explicit column count, -1 cannot be inferred without predictions
+    tp = tp.reshape(len(tp), tp.shape[1] if tp.ndim > 1 else 1)
+    num_thresholds = tp.shape[1]
 
     # Create Precision-Recall curve and compute AP for each class
     ap, p, r = [], [], []
-    for c in tqdm.tqdm(unique_classes, desc="Computing AP"):
+    for c, n_gt in zip(classes, n_gts):
         i = pred_cls == c
-        n_gt = (target_cls == c).sum()  # Number of ground truth objects
         n_p = i.sum()  # Number of predicted objects
 
         if n_p == 0 and n_gt == 0:
             continue
         elif n_p == 0 or n_gt == 0:
-            ap.append(0)
-            r.append(0)
-            p.append(0)
+            ap.append(np.zeros(num_thresholds))
+            r.append(np.zeros(num_thresholds))
+            p.append(np.zeros(num_thresholds))
         else:
             # Accumulate FPs and TPs
-            fpc = (1 - tp[i]).cumsum()
-            tpc = (tp[i]).cumsum()
+            fpc = (1 - tp[i]).cumsum(0)
+            tpc = (tp[i]).cumsum(0)
 
             # Recall
             recall_curve = tpc / (n_gt + 1e-16)
@@ -105,13 +184,15 @@ def ap_per_class(tp, conf, pred_cls, target_cls):
             p.append(precision_curve[-1])
 
             # AP from recall-precision curve
-            ap.append(compute_ap(recall_curve, precision_curve))
+            ap.append([compute_ap(recall_curve[:, t], precision_curve[:, t]) for t in range(num_thresholds)])
 
     # Compute F1 score (harmonic mean of precision and recall)
-    p, r, ap = np.array(p), np.array(r), np.array(ap)
+    p, r, ap = [np.array(x).reshape(-1, num_thresholds) for x in (p, r, ap)]
+    if single_threshold:
+        p, r, ap = p[:, 0], r[:, 0], ap[:, 0]
     f1 = 2 * p * r / (p + r + 1e-16)
 
-    return p, r, ap, f1, unique_classes.astype("int32")
+    return p, r, ap, f1, np.asarray(classes).astype("int32")
 
 
 def compute_ap(recall, precision):
@@ -129,9 +210,8 @@ def compute_ap(recall, precision):
     mrec = np.concatenate(([0.0], recall, [1.0]))
     mpre = np.concatenate(([0.0], precision, [0.0]))
 
-    # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    # compute the precision envelope (running maximum from the right)
+    mpre = np.flip(np.maximum.accumulate(np.flip(mpre)))
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -142,43 +222,119 @@ def compute_ap(recall, precision):
     return ap
 
 
-def get_batch_statistics(outputs, targets, iou_threshold):
-    """ Compute true positives, predicted scores and predicted labels per sample """
-    batch_metrics = []
-    for sample_i in range(len(outputs)):
-
-        if outputs[sample_i] is None:
-            continue
+class DetectionEvaluator(object):
+    """
+    Streaming mAP evaluation: ingests get_batch_statistics outputs batch by batch into compact,
+    geometrically grown arrays plus per-class target counts, and computes metrics at any time.
+    With 'num_thresholds' > 1 true positives are (N, T) matrices and metrics have a T column.
+    """
 
-        output = outputs[sample_i]
-        pred_boxes = output[:, :4]
-        pred_scores = output[:, 4]
-        pred_labels = output[:, -1]
+    def __init__(self, num_thresholds=1, capacity=4096):
+        self.num_predictions = 0
+        self.num_thresholds = num_thresholds
+        self.true_positives = np.zeros((capacity, num_thresholds), dtype=np.uint8)
+        self.pred_scores = np.zeros(capacity, dtype=np.float32)
+        self.pred_labels = np.zeros(capacity, dtype=np.int32)
+        self.target_counts = np.zeros(0, dtype=np.int64)
+
+    def update(self, batch_metrics, target_labels):
+        """ Adds one batch: the output of get_batch_statistics and the labels of its targets """
+        if batch_metrics:
+            true_positives, pred_scores, pred_labels = [np.concatenate(x, 0) for x in zip(*batch_metrics)]
+            start, end = self.num_predictions, self.num_predictions + len(true_positives)
+            if end > len(self.true_positives):
+                self._grow(max(end, 2 * len(self.true_positives)))
+            self.true_positives[start:end] = true_positives.reshape(len(true_positives), self.num_thresholds)
+            self.pred_scores[start:end] = pred_scores
+            self.pred_labels[start:end] = pred_labels
+            self.num_predictions = end
+
+        counts = np.bincount(np.asarray(target_labels, dtype=np.int64), minlength=len(self.target_counts))
+        counts[: len(self.target_counts)] += self.target_counts
+        self.target_counts = counts
+
+    def _grow(self, capacity):
+        for name in ("true_positives", "pred_scores", "pred_labels"):
+            array = getattr(self, name)
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[: self.num_predictions] = array[: self.num_predictions]
+            setattr(self, name, grown)
+
+    def compute(self):
+        """ Returns precision, recall, AP, f1 and the evaluated classes, as ap_per_class """
+        n = self.num_predictions
+        classes = np.nonzero(self.target_counts)[0]
+        true_positives = self.true_positives[:n].astype(np.float64)
+        return class_metrics(
+            true_positives[:, 0] if self.num_thresholds == 1 else true_positives,
+            self.pred_scores[:n],
+            self.pred_labels[:n],
+            classes,
+            self.target_counts[classes],
+        )
+
+
+def match_predictions(pred_boxes, pred_labels, pred_samples, targets, iou_threshold):
+    """
+    Greedy matching of predictions (ordered by confidence within each sample) to targets
+    (sample_i, label, x1, y1, x2, y2). A prediction is a true positive if its label occurs in
+    its sample, its best-overlapping target of that sample reaches 'iou_threshold' and no earlier
+    prediction already matched that target. Returns the true positive array, or a (N, T) matrix
+    when 'iou_threshold' is a sequence of T thresholds, all matched from the same IoU matrix.
+    """
+    thresholds = np.atleast_1d(np.asarray(iou_threshold, dtype=np.float32))
+    true_positives = np.zeros((len(pred_boxes), len(thresholds)))
+    if np.ndim(iou_threshold) == 0:
+        true_positives = true_positives[:, 0]
+    if not len(pred_boxes) or not len(targets):
+        return true_positives
+
+    same_sample = pred_samples.unsqueeze(1) == targets[:, 0].unsqueeze(0)
+    label_match = (pred_labels.unsqueeze(1) == targets[:, 1].unsqueeze(0)) & same_sample
+    iou = box_iou_matrix(pred_boxes, targets[:, 2:])
+    iou[~same_sample] = -1
+    best_ious, best_targets = iou.max(1)
+    best_ious, best_targets = best_ious.numpy(), best_targets.numpy()
+    labelled = label_match.any(1).numpy()
+
+    tp_columns = true_positives.reshape(len(pred_boxes), -1)
+    for t, threshold in enumerate(thresholds):
+        # Ignore predictions whose label is not one of the target labels or that overlap too little
+        candidates = np.nonzero(labelled & (best_ious >= threshold))[0]
+        # Only the first candidate matching each target counts
+        _, first = np.unique(best_targets[candidates], return_index=True)
+        tp_columns[candidates[first], t] = 1
+    return true_positives
 
-        true_positives = np.zeros(pred_boxes.shape[0])
 
-        annotations = targets[targets[:, 0] == sample_i][:, 1:]
-        target_labels = annotations[:, 0] if len(annotations) else []
-        if len(annotations):
-            detected_boxes = []
-            target_boxes = annotations[:, 1:]
+def get_batch_statistics(outputs, targets, iou_threshold):
+    """
+    Compute true positives, predicted scores and predicted labels per sample. The true positives
+    are (N, T) matrices when 'iou_threshold' is a sequence of T thresholds.
+    """
+    samples = [sample_i for sample_i, output in enumerate(outputs) if output is not None]
+    if not samples:
+        return []
 
-            for pred_i, (pred_box, pred_label) in enumerate(zip(pred_boxes, pred_labels)):
+    predictions = torch.cat([outputs[sample_i] for sample_i in samples])
+    pred_samples = torch.cat(
+        [torch.full((len(outputs[sample_i]),), sample_i, dtype=targets.dtype) for sample_i in samples]
+    )
+    true_positives = match_predictions(
+        predictions[:, :4], predictions[:, -1], pred_samples, targets, iou_threshold
+    )
 
-                # If targets are found break
-                if len(detected_boxes) == len(annotations):
-                    break
+    batch_metrics = []
+    splits = np.cumsum([len(outputs[sample_i]) for sample_i in samples])[:-1]
+    for sample_i, sample_tp in zip(samples, np.split(true_positives, splits)):
+        output = outputs[sample_i]
+        batch_metrics.append([sample_tp, output[:, 4], output[:, -1]])
+    return batch_metrics
 
-                # Ignore if label is not one of the target labels
-                if pred_label not in target_labels:
-                    continue
 
-                iou, box_index = bbox_iou(pred_box.unsqueeze(0), target_boxes).max(0)
-                if iou >= iou_threshold and box_index not in detected_boxes:
-                    true_positives[pred_i] = 1
-                    detected_boxes += [box_index]
-        batch_metrics.append([true_positives, pred_scores, pred_labels])
-    return batch_metrics
+def coco_iou_thresholds():
+    """ The COCO IoU sweep 0.5:0.05:0.95 """
+    return np.linspace(0.5, 0.95, 10)
 
 
 def bbox_wh_iou(wh1, wh2):
@@ -190,6 +346,29 @@ def bbox_wh_iou(wh1, wh2):
     return inter_area / union_area
 
 
+def box_iou_matrix(box1, box2, x1y1x2y2=True):
+    """
+    Returns the pairwise IoU matrix of shape (len(box1), len(box2)),
+    with the same pixel convention as bbox_iou
+    """
+    if not x1y1x2y2:
+        # Transform from center and width to exact coordinates
+        box1 = torch.cat((box1[:, :2] - box1[:, 2:4] / 2, box1[:, :2] + box1[:, 2:4] / 2), 1)
+        box2 = torch.cat((box2[:, :2] - box2[:, 2:4] / 2, box2[:, :2] + box2[:, 2:4] / 2), 1)
+
+    # Corners of the intersection rectangles
+    inter_rect_x1y1 = torch.max(box1[:, None, :2], box2[None, :, :2])
+    inter_rect_x2y2 = torch.min(box1[:, None, 2:4], box2[None, :, 2:4])
+    # Intersection area
+    inter_wh = torch.clamp(inter_rect_x2y2 - inter_rect_x1y1 + 1, min=0)
+    inter_area = inter_wh[..., 0] * inter_wh[..., 1]
+    # Union Area
+    b1_area = (box1[:, 2] - box1[:, 0] + 1) * (box1[:, 3] - box1[:, 1] + 1)
+    b2_area = (box2[:, 2] - box2[:, 0] + 1) * (box2[:, 3] - box2[:, 1] + 1)
+
+    return inter_area / (b1_area[:, None] + b2_area[None, :] - inter_area + 1e-16)
+
+
 def bbox_iou(box1, box2, x1y1x2y2=True):
     """
     Returns the IoU of two bounding boxes
@@ -223,47 +402,102 @@ def bbox_iou(box1, box2, x1y1x2y2=True):
     return iou
 
 
-def non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4):
+def non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4, compact=False, merge=True):
     """
     Removes detections with lower object confidence score than 'conf_thres' and performs
     Non-Maximum Suppression to further filter detections.
+    With 'compact' the rows of 'prediction' are (x, y, w, h, conf, cls_conf, cls_pred)
+    instead of carrying one score per class.
+    With 'merge' every kept box is replaced by the confidence-weighted mean of the boxes it suppressed.
+    'prediction' may also be a list of per-image candidates already in (x1, y1, x2, y2, ...),
+    as returned by Darknet(..., conf_thres=...) or select_candidates.
     Returns detections with shape:
         (x1, y1, x2, y2, object_conf, class_score, class_pred)
     """
 
-    # From (center x, center y, width, height) to (x1, y1, x2, y2)
-    prediction[..., :4] = xywh2xyxy(prediction[..., :4])
     output = [None for _ in range(len(prediction))]
-    for image_i, image_pred in enumerate(prediction):
+    if isinstance(prediction, (list, tuple)):
+        image_i = torch.cat(
+            [torch.full((len(rows),), i, dtype=torch.long, device=rows.device) for i, rows in enumerate(prediction)]
+        )
+        image_pred = torch.cat(prediction)
         # Filter out confidence scores below threshold
-        image_pred = image_pred[image_pred[:, 4] >= conf_thres]
-        # If none are remaining => process next image
-        if not image_pred.size(0):
-            continue
-        # Object confidence times class confidence
-        score = image_pred[:, 4] * image_pred[:, 5:].max(1)[0]
-        # Sort by it
-        image_pred = image_pred[(-score).argsort()]
+        keep = image_pred[:, 4] >= conf_thres
+        image_i, image_pred = image_i[keep], image_pred[keep]
+    else:
+        # From (center x, center y, width, height) to (x1, y1, x2, y2)
+        prediction[..., :4] = xywh2xyxy(prediction[..., :4])
+        # Filter out confidence scores below threshold, over the whole batch at once
+        image_i, anchor_i = (prediction[..., 4] >= conf_thres).nonzero(as_tuple=True)
+        image_pred = prediction[image_i, anchor_i]
+    if not image_i.numel():
+        return output
+    if compact:
+        class_confs, class_preds = image_pred[:, 5:6], image_pred[:, 6:7]
+    else:
         class_confs, class_preds = image_pred[:, 5:].max(1, keepdim=True)
-        detections = torch.cat((image_pred[:, :5], class_confs.float(), class_preds.float()), 1)
-        # Perform non-maximum suppression
-        keep_boxes = []
-        while detections.size(0):
-            large_overlap = bbox_iou(detections[0, :4].unsqueeze(0), detections[:, :4]) > nms_thres
-            label_match = detections[0, -1] == detections[:, -1]
-            # Indices of boxes with lower confidence scores, large IOUs and matching labels
-            invalid = large_overlap & label_match
-            weights = detections[invalid, 4:5]
-            # Merge overlapping bboxes by order of confidence
-            detections[0, :4] = (weights * detections[invalid, :4]).sum(0) / weights.sum()
-            keep_boxes += [detections[0]]
-            detections = detections[~invalid]
-        if keep_boxes:
-            output[image_i] = torch.stack(keep_boxes)
+    # Object confidence times class confidence
+    score = image_pred[:, 4] * class_confs[:, 0]
+    detections = torch.cat((image_pred[:, :5], class_confs.float(), class_preds.float()), 1)
+
+    # Sort by image, then by score
+    order = (-score).argsort()
+    order = order[image_i[order].sort(stable=True)[1]]
+    detections, score, image_i = detections[order], score[order], image_i[order]
+
+    # Suppress per (image, class) in one call; shifting x2/y2 by one pixel reproduces the IoU of bbox_iou
+    num_groups = int(detections[:, -1].max().item()) + 1
+    boxes = detections[:, :4].clone()
+    boxes[:, 2:] += 1
+    keep = batched_nms(boxes, score, image_i * num_groups + detections[:, -1].long(), nms_thres)
+    keep = keep.sort()[0]
+
+    counts = torch.bincount(image_i, minlength=len(prediction)).tolist()
+    keep_counts = torch.bincount(image_i[keep], minlength=len(prediction)).tolist()
+    starts = np.cumsum([0] + counts)
+    for i, (image_dets, image_keep) in enumerate(
+        zip(torch.split(detections, counts), torch.split(keep, keep_counts))
+    ):
+        if not len(image_keep):
+            continue
+        image_keep = image_keep - int(starts[i])
+        kept = image_dets[image_keep]
+        if merge:
+            kept = kept.clone()
+            # Each box is merged into the first kept box, by order of confidence, that suppressed it
+            overlap = (
+                (box_iou_matrix(kept[:, :4], image_dets[:, :4]) > nms_thres)
+                & (kept[:, -1:] == image_dets[:, -1].unsqueeze(0))
+                & (image_keep.unsqueeze(1) <= torch.arange(len(image_dets), device=kept.device).unsqueeze(0))
+            )
+            assigned = overlap.any(0)
+            owner = overlap.float().argmax(0)[assigned]
+            weights = image_dets[assigned, 4:5]
+            merged = kept.new_zeros(len(kept), 4).index_add_(0, owner, weights * image_dets[assigned, :4])
+            weight_sums = kept.new_zeros(len(kept), 1).index_add_(0, owner, weights)
+            kept[:, :4] = merged / weight_sums
+        output[i] = kept
 
     return output
 
 
+def detections_agree(reference, detections, box_tol=2.0):
+    """
+    Checks that two outputs of non_max_suppression keep the same boxes with the same classes,
+    with box corners within 'box_tol' pixels
+    """
+    for ref, det in zip(reference, detections):
+        if ref is None or det is None:
+            if ref is not det:
+                return False
+            continue
+        if ref.shape != det.shape or not torch.equal(ref[:, -1].cpu(), det[:, -1].cpu()):
+            return False
+        if (ref[:, :4].cpu() - det[:, :4].cpu()).abs().max() > box_tol:
+            return False
+    return True
+
+
 def build_targets(pred_boxes, pred_cls, target, anchors, ignore_thres):
 
     ByteTensor = torch.cuda.ByteTensor if pred_boxes.is_cuda else torch.ByteTensor
@@ -272,21 +506,22 @@ def build_targets(pred_boxes, pred_cls, target, anchors, ignore_thres):
     nB = pred_boxes.size(0)
     nA = pred_boxes.size(1)
     nC = pred_cls.size(-1)
-    nG = pred_boxes.size(2)
+    nGh = pred_boxes.size(2)
+    nGw = pred_boxes.size(3)
 
     # Output tensors
-    obj_mask = ByteTensor(nB, nA, nG, nG).fill_(0)
-    noobj_mask = ByteTensor(nB, nA, nG, nG).fill_(1)
-    class_mask = FloatTensor(nB, nA, nG, nG).fill_(0)
-    iou_scores = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tx = FloatTensor(nB, nA, nG, nG).fill_(0)
-    ty = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tw = FloatTensor(nB, nA, nG, nG).fill_(0)
-    th = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tcls = FloatTensor(nB, nA, nG, nG, nC).fill_(0)
-
-    # Convert to position relative to box
-    target_boxes = target[:, 2:6] * nG
+    obj_mask = ByteTensor(nB, nA, nGh, nGw).fill_(0)
+    noobj_mask = ByteTensor(nB, nA, nGh, nGw).fill_(1)
+    class_mask = FloatTensor(nB, nA, nGh, nGw).fill_(0)
+    iou_scores = FloatTensor(nB, nA, nGh, nGw).fill_(0)
+    tx = FloatTensor(nB, nA, nGh, nGw).fill_(0)
+    ty = FloatTensor(nB, nA, nGh, nGw).fill_(0)
+    tw = FloatTensor(nB, nA, nGh, nGw).fill_(0)
+    th = FloatTensor(nB, nA, nGh, nGw).fill_(0)
+    tcls = FloatTensor(nB, nA, nGh, nGw, nC).fill_(0)
+
+    # Convert to position relative to box, x and w in grid columns, y and h in grid rows
+    target_boxes = target[:, 2:6] * target.new_tensor([nGw, nGh, nGw, nGh])
     gxy = target_boxes[:, :2]
     gwh = target_boxes[:, 2:]
     # Get anchors with best iou